@@ -0,0 +1,41 @@
+"""Compare rehashing the key per block with cloning a key-absorbed state.
+
+Run with ``python benchmarks/bench_prefix.py``.
+"""
+from __future__ import print_function, unicode_literals
+
+import timeit
+
+import hashcrypto
+from hashcrypto import Q
+
+
+def main(blocks=20000):
+    print("{0:<8} {1:>12} {2:>12} {3:>8}".format(
+        "hash", "rehash [s]", "prefix [s]", "speedup"))
+    for name in sorted(hashcrypto.fast_lookup):
+        h = hashcrypto.fast_lookup[name]
+        if name in hashcrypto.keyed_lookup or isinstance(h, hashcrypto.XOF):
+            # these never used the rehashing construction
+            continue
+        key = b"k" * hashcrypto.CTR.suggest_key_size(h)
+        crypt = hashcrypto.CTR(key, h)
+        nonce = crypt.nonce
+
+        def rehash():
+            for counter in range(blocks):
+                h(key + nonce + Q.pack(counter)).digest()
+
+        def prefix():
+            ks = crypt.keystream(0)
+            for _ in range(blocks):
+                next(ks)
+
+        old = min(timeit.repeat(rehash, number=1, repeat=3))
+        new = min(timeit.repeat(prefix, number=1, repeat=3))
+        print("{0:<8} {1:>12.4f} {2:>12.4f} {3:>7.2f}x".format(
+            name, old, new, old / new))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,13 @@
 from __future__ import print_function, unicode_literals, absolute_import
 
 import hashlib
+import io
+import mmap
+import os
 from os import urandom
 import sys
 from struct import Struct
+from itertools import chain
 
 if sys.version_info >= (3, 0):
     unicode = str
@@ -11,10 +15,9 @@ if sys.version_info >= (3, 0):
 else:
     from itertools import imap as short_map
 
-try:
-    from bytesop import op_xor
-except ImportError:
-    from hashcrypto.bytesop_fallback import op_xor
+from hashcrypto.xor import op_xor
+from hashcrypto.stats import clock
+from hashcrypto.tuning import setting as tuned_setting
 
 
 __version__ = "0.4"
@@ -49,60 +52,394 @@ def read_plus(f):
 class IVError(ValueError):
     pass
 
+
+class AuthenticationError(ValueError):
+    pass
+
 fast_lookup = {"md5": hashlib.md5, "sha1": hashlib.sha1, "sha224": hashlib.sha224,
                "sha256": hashlib.sha256, "sha384": hashlib.sha384, "sha512": hashlib.sha512}
 
 
+class Keyed(object):
+    """Constructor for a hash used with its native key parameter (BLAKE2).
+
+    Its name ("blake2b-keyed") differs from the plain hash name, which keeps
+    meaning hash(key + input) as in files written before keyed hashing.
+    """
+
+    def __init__(self, constructor, name):
+        self.constructor = constructor
+        self.name = name
+        self.MAX_KEY_SIZE = constructor.MAX_KEY_SIZE
+
+    def __call__(self, b=b"", **kwargs):
+        return self.constructor(b, **kwargs)
+
+    @property
+    def spec(self):
+        return self.name
+
+    def __repr__(self):
+        return "Keyed({0!r})".format(self.name)
+
+# hashes with a native key parameter, used instead of hash(key + input)
+keyed_lookup = {}
+for _name in ("blake2b", "blake2s"):
+    if hasattr(hashlib, _name):
+        fast_lookup[_name] = getattr(hashlib, _name)
+        keyed_lookup[_name + "-keyed"] = fast_lookup[_name + "-keyed"] = Keyed(
+            getattr(hashlib, _name), _name + "-keyed")
+del _name
+
+DEFAULT_XOF_LENGTH = 4096
+# limit for lengths read from headers, every hash call allocates this much
+MAX_XOF_LENGTH = 1 << 20
+
+
+class XOF(object):
+    """Constructor for an extendable-output hash (SHAKE) with a fixed output length.
+
+    Every hash call then yields length bytes of keystream. Hash names of
+    the form "shake_256:4096" are resolved to XOF("shake_256", 4096).
+    """
+
+    def __init__(self, name, length=DEFAULT_XOF_LENGTH):
+        if not 0 < length <= MAX_XOF_LENGTH:
+            raise ValueError("XOF output length must be between 1 and MAX_XOF_LENGTH", length)
+        try:
+            # only XOFs have a variable digest size (0 in hashlib)
+            xof = hashlib.new(name).digest_size == 0
+        except (ValueError, TypeError):
+            xof = False
+        if not xof:
+            raise ValueError("Not an extendable-output hash", name)
+        self.name = name
+        self.length = length
+
+    def __call__(self, b=b""):
+        return hashlib.new(self.name, b)
+
+    @property
+    def spec(self):
+        return "{0}:{1}".format(self.name, self.length)
+
+    def __repr__(self):
+        return "XOF({0!r}, {1!r})".format(self.name, self.length)
+
+for _name in ("shake_128", "shake_256"):
+    if hasattr(hashlib, _name):
+        fast_lookup[_name] = XOF(_name)
+
+# recommended (fastest on 64 bit CPUs) hash for new data
+DEFAULT_HASH = "blake2b-keyed" if "blake2b-keyed" in keyed_lookup else "sha512"
+
+
+def is_keyed(hash_constructor):
+    return isinstance(hash_constructor, Keyed)
+
+
+def lookup_hash(h):
+    if isinstance(h, (unicode, bytes)):
+        if isinstance(h, bytes):
+            h = h.decode("ascii")
+        if ":" in h:
+            name, length = h.split(":", 1)
+            return XOF(name, int(length))
+        n = hashlib.new
+        return fast_lookup.get(h, (lambda b=b"": n(h, b)))
+    return h
+
+
+def default_hash(key):
+    """Hash for new files when none is given: the tuned one, else sha512.
+
+    Only used where the hash is recorded in a header (hashenc, encrypt_tree,
+    parallel_encrypt_file). HashCrypt and the modes always default to
+    sha512, so data without a header decrypts regardless of the profile.
+    """
+    h = lookup_hash(tuned_setting("hash", "sha512"))
+    if is_keyed(h) and len(key) > h.MAX_KEY_SIZE:
+        return hashlib.sha512
+    return h
+
+
+DEFAULT_BUFFER_SIZE = 4 * 1024 * 1024
+
+
+def readinto_full(infile, buffer):
+    """Read into buffer until it is full or infile is exhausted.
+
+    Returns the number of bytes read. Short reads (pipes, sockets) are retried.
+    """
+    mv = memoryview(buffer)
+    size = len(mv)
+    readinto = getattr(infile, "readinto", None)
+    pos = 0
+    while pos < size:
+        if readinto is not None:
+            n = readinto(mv[pos:])
+        else:
+            b = infile.read(size - pos)
+            n = len(b)
+            mv[pos:pos + n] = b
+        if not n:
+            break
+        pos += n
+    return pos
+
+
+def read_chunks(infile, chunk_size):
+    """Yield chunks of exactly chunk_size bytes (except the last one).
+
+    All chunks are memoryviews of one reused buffer, so each must be
+    consumed before the next is requested.
+    """
+    mv = memoryview(bytearray(chunk_size))
+    while True:
+        n = readinto_full(infile, mv)
+        if n:
+            yield mv[:n]
+        if n < chunk_size:
+            return
+
+
+def iter_blocks(data, block_size):
+    mv = memoryview(data)
+    return (mv[i:i + block_size] for i in range(0, len(mv), block_size))
+
+
+def split_many(data, offsets):
+    """Split the output of encrypt_many/decrypt_many into single messages."""
+    return [data[start:stop] for start, stop in zip(offsets, offsets[1:])]
+
+
+def counted_reads(chunks, stats):
+    if stats is None:
+        return chunks
+    return stats.timed_reads(chunks)
+
+
+def write_chunks(outfile, chunks, stats=None):
+    if stats is None:
+        for chunk in chunks:
+            outfile.write(chunk)
+    else:
+        for chunk in chunks:
+            stats.write(outfile, chunk)
+
+
 def read_file(infile, block_size):
-    b = infile.read(block_size)
-    while b:
-        yield b
-        b = infile.read(block_size)
+    for b in read_chunks(infile, block_size):
+        yield bytes(b)
 
 
-class HashCrypt(object):
+MAGIC = b"HASHCRYPT"
+
 
-    def __init__(self, key, hash_constructor=hashlib.sha512):
-        if isinstance(hash_constructor, (unicode, bytes)):
-            h = hash_constructor
-            n = hashlib.new
-            hash_constructor = fast_lookup.get(h, (lambda b: n(h, b)))
+class HashCrypt(object):
+    # number of pack_plus fields following the mode name in header()
+    header_fields = 1
+    # optional hashcrypto.stats.Stats instance
+    stats = None
+
+    def __init__(self, key, hash_constructor=None):
+        if hash_constructor is None:
+            hash_constructor = hashlib.sha512
+        hash_constructor = lookup_hash(hash_constructor)
         self.hash = hash_constructor
+        self.keyed = is_keyed(hash_constructor)
         self.key = key
-        self.block_size = hash_constructor().digest_size
+        if isinstance(hash_constructor, XOF):
+            self.block_size = hash_constructor.length
+            self._digest_args = (hash_constructor.length,)
+        else:
+            self.block_size = hash_constructor().digest_size
+            self._digest_args = ()
+
+    @property
+    def key(self):
+        return self._key
+
+    @key.setter
+    def key(self, key):
+        self._key = key
+        if self.keyed:
+            self._key_state = self.hash(key=key)
+        else:
+            self._key_state = self.hash(key)
+
+    def prefix(self, b):
+        """Return a copy of the key-absorbed hash state with b appended."""
+        h = self._key_state.copy()
+        h.update(b)
+        return h
 
     def block(self, b):
-        return self.hash(self.key + b).digest()
+        h = self._key_state.copy()
+        h.update(b)
+        return h.digest(*self._digest_args)
 
     def encrypt_file(self, infile, outfile, *args, **kwargs):
         outfile.write(self.header())
         self.encrypt_stream(infile, outfile, *args, **kwargs)
 
+    def encrypt_file_inplace(self, path, sidecar=None, buffer_size=None, **kwargs):
+        """Encrypt the file at path in place through mmap.
+
+        The header goes to sidecar (default: path + SIDECAR_SUFFIX), which
+        must not exist yet and is written before the data is touched. The
+        sidecar also journals the progress (see InplaceJournal): an
+        interrupted run is continued by resume_file_inplace or undone by
+        decrypt_file_inplace.
+        """
+        if sidecar is None:
+            sidecar = path + SIDECAR_SUFFIX
+        # O_EXCL: a second run must not replace the header of the first
+        fd = os.open(sidecar, os.O_RDWR | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0),
+                     0o600)
+        with io.open(fd, "r+b") as f:
+            header = self.header()
+            f.write(header)
+            journal = InplaceJournal(f, len(header))
+            journal.commit(0)
+            size = self.aligned_buffer_size(buffer_size)
+            crypt_inplace(path, lambda chunks: self.encrypt_chunks(chunks, **kwargs), size,
+                          journal=journal)
+
     def encrypt_stream(self, infile, outfile, *args, **kwargs):
-        for block in self.encrypt(read_file(infile, self.block_size), *args, **kwargs):
-            outfile.write(block)
+        self._stream(self.encrypt_chunks, infile, outfile, args, kwargs)
 
     def decrypt_stream(self, infile, outfile, *args, **kwargs):
-        for block in self.decrypt(read_file(infile, self.block_size), *args, **kwargs):
-            outfile.write(block)
+        self._stream(self.decrypt_chunks, infile, outfile, args, kwargs)
+
+    def _stream(self, process, infile, outfile, args, kwargs):
+        size = self.aligned_buffer_size(kwargs.pop("buffer_size", None))
+        depth = kwargs.pop("pipeline_depth", None)
+        if kwargs.get("workers") is None and tuned_setting("workers", 1) > 1:
+            kwargs["workers"] = tuned_setting("workers")
+        if depth:
+            from hashcrypto.pipeline import run_pipeline
+            run_pipeline(lambda chunks: process(chunks, *args, **kwargs),
+                         infile, outfile, size, depth, self.stats)
+            return
+        chunks = counted_reads(read_chunks(infile, size), self.stats)
+        write_chunks(outfile, process(chunks, *args, **kwargs), self.stats)
+
+    def aligned_buffer_size(self, buffer_size=None):
+        """Round buffer_size down to a positive multiple of block_size."""
+        if buffer_size is None:
+            buffer_size = tuned_setting("buffer_size", DEFAULT_BUFFER_SIZE)
+        return max(buffer_size - buffer_size % self.block_size, self.block_size)
+
+    def xor_keystream_chunks(self, chunks, state):
+        """XOR chunks with self.keystream_into, continuing from state.
+
+        All chunks but the last must be a multiple of block_size long.
+        """
+        ks = bytearray(0)
+        for chunk in chunks:
+            n = len(chunk)
+            if len(ks) < n:
+                ks = bytearray(n)
+            kv = memoryview(ks)[:n]
+            state = self.fill_keystream(kv, state)
+            yield self.xor(chunk, kv)
+
+    def fill_keystream(self, buffer, state):
+        """self.keystream_into, counted in self.stats if set."""
+        stats = self.stats
+        if stats is None:
+            return self.keystream_into(buffer, state)
+        t = clock()
+        state = self.keystream_into(buffer, state)
+        stats.add("hash", clock() - t, blocks=-(-len(buffer) // self.block_size))
+        return state
+
+    def xor(self, a, b):
+        """op_xor for whole chunks, counted in self.stats if set."""
+        stats = self.stats
+        if stats is None:
+            return op_xor(a, b)
+        t = clock()
+        r = op_xor(a, b)
+        stats.add("xor", clock() - t, len(r))
+        return r
+
+    def encrypt_many(self, items, workers=None):
+        """Encrypt many short messages, given as (iv_or_nonce, payload) pairs.
+
+        Returns (data, offsets): message i is data[offsets[i]:offsets[i + 1]],
+        see split_many. With workers > 1 batches go to a process pool.
+        """
+        return self._many(items, workers, False)
+
+    def decrypt_many(self, items, workers=None):
+        """Counterpart of encrypt_many, taking (iv_or_nonce, ciphertext) pairs."""
+        return self._many(items, workers, True)
+
+    def _many(self, items, workers, decrypt):
+        if workers is not None and workers > 1:
+            from hashcrypto.parallel import crypt_many
+            return crypt_many(self, items, decrypt, workers)
+        return self.crypt_batch(list(items), decrypt)
+
+    def crypt_batch(self, items, decrypt=False):
+        """Process a list of (iv_or_nonce, payload) pairs with one XOR over all payloads."""
+        offsets = [0]
+        for _, payload in items:
+            offsets.append(offsets[-1] + len(payload))
+        data = b"".join(payload for _, payload in items)
+        ks = memoryview(bytearray(len(data)))
+        for (iv, _), start, stop in zip(items, offsets, offsets[1:]):
+            self.message_keystream_into(ks[start:stop], iv)
+        return self.xor(data, ks), offsets
 
     def header(self):
-        return b"HASHCRYPT" + (b"".join(short_map(pack_plus, (__version__, self.__class__.__name__, self.hash_name()))))
+        return MAGIC + (b"".join(short_map(pack_plus, (__version__, self.__class__.__name__, self.hash_name()))))
 
     def hash_name(self):
+        if isinstance(self.hash, (XOF, Keyed)):
+            return self.hash.spec
         return self.hash().name
 
+    @classmethod
+    def from_header(cls, key, fields):
+        """Create an instance from the header fields following the mode name."""
+        return cls(key, fields[0].decode("ascii"), *fields[1:])
+
+    def __copy__(self):
+        # shares the key-absorbed state, which is only ever copied, never updated
+        c = self.__class__.__new__(self.__class__)
+        c.__dict__.update(self.__dict__)
+        return c
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_key_state"]
+        state.pop("stats", None)
+        state["hash"] = self.hash_name()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.hash = lookup_hash(self.hash)
+        self.key = self._key
+
     @classmethod
     def suggest_key_size(cls, hash_constructor):
+        hash_constructor = lookup_hash(hash_constructor)
+        if is_keyed(hash_constructor):
+            return hash_constructor.MAX_KEY_SIZE
         return max(hash_constructor().block_size, 32)
 
 
 class WithIV(HashCrypt):
+    header_fields = 2
 
-    def __init__(self, key, hash_constructor=hashlib.sha512, start_iv=None):
+    def __init__(self, key, hash_constructor=None, start_iv=None):
         super(WithIV, self).__init__(key, hash_constructor)
         if start_iv is None:
-            start_iv = self.make_iv(hash_constructor)
+            start_iv = self.make_iv(self.hash)
         self.start_iv = start_iv
 
     def header(self):
@@ -118,11 +455,12 @@ class WithIV(HashCrypt):
 
 
 class WithNonce(HashCrypt):
+    header_fields = 2
 
-    def __init__(self, key, hash_constructor=hashlib.sha512, nonce=None):
+    def __init__(self, key, hash_constructor=None, nonce=None):
         super(WithNonce, self).__init__(key, hash_constructor)
         if nonce is None:
-            nonce = self.make_nonce(hash_constructor)
+            nonce = self.make_nonce(self.hash)
         self.nonce = nonce
 
     def header(self):
@@ -136,10 +474,62 @@ class WithNonce(HashCrypt):
 class CTR(WithNonce):
 
     def keystream(self, counter_start):
+        prefix = self.prefix(self.nonce)
+        args = self._digest_args
         counter = counter_start
         while True:
-            yield self.block(self.nonce + Q.pack(counter))
+            h = prefix.copy()
+            h.update(Q.pack(counter))
+            yield h.digest(*args)
+            counter += 1
+
+    def keystream_into(self, buffer, counter_start=0, nonce=None):
+        """Fill buffer with keystream from counter_start on.
+
+        nonce defaults to self.nonce.
+        Returns the counter of the first block not (fully) written.
+        """
+        mv = memoryview(buffer)
+        size = len(mv)
+        bs = self.block_size
+        prefix = self.prefix(self.nonce if nonce is None else nonce)
+        args = self._digest_args
+        counter = counter_start
+        pack = Q.pack
+        for pos in range(0, size - bs + 1, bs):
+            h = prefix.copy()
+            h.update(pack(counter))
+            mv[pos:pos + bs] = h.digest(*args)
+            counter += 1
+        rest = size % bs
+        if rest:
+            h = prefix.copy()
+            h.update(pack(counter))
+            mv[size - rest:] = h.digest(*args)[:rest]
             counter += 1
+        return counter
+
+    def encrypt_buffer(self, data, counter_start=0):
+        ks = bytearray(len(data))
+        self.fill_keystream(ks, counter_start)
+        return self.xor(data, ks)
+
+    decrypt_buffer = encrypt_buffer
+
+    def message_keystream_into(self, buffer, nonce):
+        self.keystream_into(buffer, 0, nonce)
+
+    def resume_args(self, infile, pos):
+        """Return encrypt_chunks keyword arguments continuing at pos of the ciphertext infile."""
+        return {"counter_start": pos // self.block_size}
+
+    def encrypt_chunks(self, chunks, counter_start=0, workers=None):
+        if workers is not None and workers > 1:
+            from hashcrypto.parallel import ctr_encrypt_chunks
+            return ctr_encrypt_chunks(self, chunks, counter_start, workers)
+        return self.xor_keystream_chunks(chunks, counter_start)
+
+    decrypt_chunks = encrypt_chunks
 
     def encrypt(self, plain_blocks, counter_start=0):
         return short_map(op_xor, plain_blocks, self.keystream(counter_start))
@@ -149,11 +539,21 @@ class CTR(WithNonce):
     def encrypt_block(self, b, counter):
         if len(b) != self.block_size:
             raise ValueError("Wrong size for input", len(b))
-        d = self.block(self.nonce + Q.pack(counter))
-        return op_xor(b, d)
+        h = self.prefix(self.nonce)
+        h.update(Q.pack(counter))
+        return op_xor(b, h.digest(*self._digest_args))
 
     decrypt_block = encrypt_block
 
+    def encrypt_at(self, data, offset):
+        """Encrypt data located offset bytes into a stream started at counter 0."""
+        counter, skip = divmod(offset, self.block_size)
+        ks = bytearray(skip + len(data))
+        self.fill_keystream(ks, counter)
+        return self.xor(data, memoryview(ks)[skip:])
+
+    decrypt_at = encrypt_at
+
     @classmethod
     def suggest_nonce_size(cls, hash_constructor):
         return max(hash_constructor().block_size - Q.size, 32)
@@ -172,6 +572,75 @@ class OFB(WithIV):
             iv = self.block(iv)
             yield iv
 
+    def keystream_into(self, buffer, iv=None):
+        """Fill buffer with keystream continuing from iv.
+
+        Returns the iv to continue with after the last (fully) written block.
+        """
+        if iv is None:
+            iv = self.start_iv
+        if iv is None:
+            raise IVError(
+                "If iv is omitted or None, self.start_iv must be set.")
+
+        mv = memoryview(buffer)
+        size = len(mv)
+        bs = self.block_size
+        block = self.block
+        for pos in range(0, size - bs + 1, bs):
+            iv = block(iv)
+            mv[pos:pos + bs] = iv
+        rest = size % bs
+        if rest:
+            iv = block(iv)
+            mv[size - rest:] = iv[:rest]
+        return iv
+
+    def encrypt_buffer(self, data, iv=None):
+        ks = bytearray(len(data))
+        self.fill_keystream(ks, iv)
+        return self.xor(data, ks)
+
+    decrypt_buffer = encrypt_buffer
+
+    def message_keystream_into(self, buffer, iv):
+        self.keystream_into(buffer, iv)
+
+    def resume_args(self, infile, pos):
+        """Return encrypt_chunks keyword arguments continuing at pos of the ciphertext infile."""
+        # the register is not stored, run the keystream up to pos
+        iv = self.start_iv
+        for _ in range(pos // self.block_size):
+            iv = self.block(iv)
+        return {"iv": iv}
+
+    def encrypt_chunks(self, chunks, iv=None, workers=None, checkpoints=None):
+        # OFB is inherently sequential, workers is accepted for symmetry only
+        if checkpoints is not None:
+            return self._checkpointed_chunks(chunks, iv, checkpoints)
+        return self.xor_keystream_chunks(chunks, iv)
+
+    def _checkpointed_chunks(self, chunks, iv, checkpoints):
+        if iv is None:
+            iv = self.start_iv
+        bs = self.block_size
+        interval = checkpoints.interval
+        index = 0
+        for chunk in chunks:
+            n = len(chunk)
+            kv = memoryview(bytearray(n))
+            pos = 0
+            while pos < n:
+                if not index % interval:
+                    checkpoints.add(index // interval, iv)
+                step = min((interval - index % interval) * bs, n - pos)
+                iv = self.fill_keystream(kv[pos:pos + step], iv)
+                index += -(-step // bs)
+                pos += step
+            yield self.xor(chunk, kv)
+
+    decrypt_chunks = encrypt_chunks
+
     def encrypt(self, plain_blocks, iv=None):
         if iv is None:
             iv = self.start_iv
@@ -214,15 +683,299 @@ class CFB(WithIV):
         d = self.block(iv)
         return op_xor(b, d)
 
+    def encrypt_buffer(self, data, iv=None):
+        stats = self.stats
+        t = clock() if stats is not None else None
+        out = b"".join(self.encrypt(iter_blocks(data, self.block_size), iv))
+        if stats is not None:
+            # hashing and XOR alternate per block here, all time counts as hashing
+            stats.add("hash", clock() - t, blocks=-(-len(out) // self.block_size))
+            stats.add("xor", 0.0, len(out))
+        return out
+
+    def decrypt_buffer(self, data, iv=None):
+        if iv is None:
+            iv = self.start_iv
+        if iv is None:
+            raise IVError(
+                "If iv is omitted or None, self.start_iv must be set.")
+
+        mv = memoryview(data)
+        bs = self.block_size
+        prev = mv[:(len(mv) - 1) // bs * bs]
+        stats = self.stats
+        t = clock() if stats is not None else None
+        ks = b"".join(short_map(self.block, chain((iv,), iter_blocks(prev, bs))))
+        if stats is not None:
+            stats.add("hash", clock() - t, blocks=len(prev) // bs + 1)
+        return self.xor(data, ks)
+
+    def crypt_batch(self, items, decrypt=False):
+        func = self.decrypt_buffer if decrypt else self.encrypt_buffer
+        offsets = [0]
+        parts = []
+        for iv, payload in items:
+            parts.append(func(payload, iv))
+            offsets.append(offsets[-1] + len(payload))
+        return b"".join(parts), offsets
+
+    def resume_args(self, infile, pos):
+        """Return encrypt_chunks keyword arguments continuing at pos of the ciphertext infile."""
+        if not pos:
+            return {}
+        infile.seek(pos - self.block_size)
+        return {"iv": infile.read(self.block_size)}
+
+    def encrypt_chunks(self, chunks, iv=None, workers=None):
+        # CFB encryption is inherently sequential, workers is accepted for symmetry only
+        bs = self.block_size
+        for chunk in chunks:
+            out = self.encrypt_buffer(chunk, iv)
+            iv = out[-bs:]
+            yield out
+
+    def decrypt_chunks(self, chunks, iv=None, workers=None):
+        if workers is not None and workers > 1:
+            from hashcrypto.parallel import cfb_decrypt_chunks
+            return cfb_decrypt_chunks(self, chunks, iv, workers)
+        return self._decrypt_chunks(chunks, iv)
+
+    def _decrypt_chunks(self, chunks, iv):
+        bs = self.block_size
+        for chunk in chunks:
+            out = self.decrypt_buffer(chunk, iv)
+            iv = bytes(chunk[-bs:])
+            yield out
+
 MODES = {"CTR": CTR, "OFB": OFB, "CFB": CFB}
 
+# header names of formats wrapping a mode, filled in by their modules
+CONTAINERS = {}
+
+
+def lookup_mode(mode):
+    if isinstance(mode, bytes):
+        mode = mode.decode("ascii")
+    try:
+        return MODES[mode]
+    except KeyError:
+        raise ValueError("Unknown mode", mode)
 
-def decrypt_file(infile, outfile, key):
-    if infile.read(9) != b"HASHCRYPT":
+
+def lookup_format(name):
+    if name in CONTAINERS:
+        return CONTAINERS[name]
+    return lookup_mode(name)
+
+
+def read_header(infile, key):
+    """Parse a header written by HashCrypt.header() and return the matching object.
+
+    Afterwards infile is positioned at the start of the ciphertext.
+    """
+    if infile.read(len(MAGIC)) != MAGIC:
         raise ValueError("Bad Header")
     ver = read_plus(infile).decode("ascii")
-    mode = read_plus(infile).decode("ascii")
-    h = read_plus(infile).decode("ascii")
-    iv_nonce = read_plus(infile)
-    obj = MODES[mode](key, h, iv_nonce)
-    obj.decrypt_stream(infile, outfile)
+    cls = lookup_format(read_plus(infile).decode("ascii"))
+    fields = [read_plus(infile) for _ in range(cls.header_fields)]
+    return cls.from_header(key, fields)
+
+
+def decrypt_file(infile, outfile, key, buffer_size=None, workers=None, stats=None,
+                 pipeline_depth=None):
+    obj = read_header(infile, key)
+    if stats is not None:
+        obj.stats = stats
+    kwargs = {}
+    if pipeline_depth:
+        kwargs["pipeline_depth"] = pipeline_depth
+    obj.decrypt_stream(infile, outfile, buffer_size=buffer_size, workers=workers, **kwargs)
+
+
+SIDECAR_SUFFIX = ".hcheader"
+
+
+class InplaceJournal(object):
+    """Progress record of an in-place encryption, stored in the sidecar after the header.
+
+    The record is Q bytes done + Q length of a pending chunk, followed by
+    the ciphertext of the pending chunk. Each chunk is saved here before
+    it overwrites the file, so after an interruption the file is encrypted
+    exactly up to done once the pending chunk is written again (replay).
+    """
+
+    def __init__(self, f, offset):
+        self.f = f
+        self.offset = offset
+
+    def _sync(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    def read(self):
+        """Return (done, pending ciphertext), or None for a sidecar without journal."""
+        self.f.seek(self.offset)
+        record = self.f.read(2 * Q.size)
+        if len(record) < 2 * Q.size:
+            return None
+        done, pending = Q.unpack_from(record)[0], Q.unpack_from(record, Q.size)[0]
+        data = self.f.read(pending)
+        if len(data) != pending:
+            raise ValueError("Truncated in-place journal")
+        return done, data
+
+    def begin(self, pos, data):
+        """Save the ciphertext data of the chunk about to be written at pos (= done)."""
+        self.f.seek(self.offset + 2 * Q.size)
+        self.f.write(data)
+        self._sync()
+        self.f.seek(self.offset)
+        self.f.write(Q.pack(pos) + Q.pack(len(data)))
+        self._sync()
+
+    def commit(self, done):
+        """Record that everything before done is encrypted and drop the pending chunk."""
+        self.f.seek(self.offset)
+        self.f.write(Q.pack(done) + Q.pack(0))
+        self.f.truncate(self.offset + 2 * Q.size)
+        self._sync()
+
+    def replay(self, path):
+        """Write a pending chunk to the file at path; return the number of bytes done."""
+        done, data = self.read()
+        if data:
+            with io.open(path, "r+b") as f:
+                f.seek(done)
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            done += len(data)
+            self.commit(done)
+        return done
+
+
+def crypt_inplace(path, process, chunk_size, start=0, end=None, journal=None):
+    """Replace the content of the file at path chunk by chunk via mmap.
+
+    process maps an iterable of memoryviews (the chunks from start to end)
+    to an iterable of equally long results. Each chunk is written back
+    after its result arrives, so if process fails the file is left partly
+    processed. With a journal (InplaceJournal), every result is journaled
+    before it is written and committed once it is flushed.
+    """
+    with io.open(path, "r+b") as f:
+        if not os.fstat(f.fileno()).st_size:
+            return
+        m = mmap.mmap(f.fileno(), 0)
+        mv = memoryview(m)
+        if end is None:
+            end = len(mv)
+        chunks = (mv[i:min(i + chunk_size, end)] for i in range(start, end, chunk_size))
+        results = None
+        done = False
+        try:
+            results = process(chunks)
+            pos = start
+            for out in results:
+                if journal is not None:
+                    journal.begin(pos, out)
+                mv[pos:pos + len(out)] = out
+                pos += len(out)
+                if journal is not None:
+                    m.flush()
+                    journal.commit(pos)
+            m.flush()
+            done = True
+        finally:
+            for it in (results, chunks):
+                close = getattr(it, "close", None)
+                if close is not None:
+                    close()
+            mv.release()
+            try:
+                m.close()
+            except BufferError:
+                # the traceback of an exception raised by process still
+                # references views of m, it is unmapped once they are gone
+                if done:
+                    raise
+
+
+def resume_file_inplace(path, key, sidecar=None, buffer_size=None, workers=None):
+    """Continue an interrupted HashCrypt.encrypt_file_inplace."""
+    if sidecar is None:
+        sidecar = path + SIDECAR_SUFFIX
+    with io.open(sidecar, "r+b") as f:
+        obj = read_header(f, key)
+        journal = InplaceJournal(f, f.tell())
+        if journal.read() is None:
+            raise ValueError("Sidecar has no in-place journal")
+        done = journal.replay(path)
+        with io.open(path, "rb") as data:
+            kwargs = obj.resume_args(data, done)
+        if workers is not None:
+            kwargs["workers"] = workers
+        size = obj.aligned_buffer_size(buffer_size)
+        crypt_inplace(path, lambda chunks: obj.encrypt_chunks(chunks, **kwargs), size,
+                      start=done, journal=journal)
+
+
+def decrypt_file_inplace(path, key, sidecar=None, buffer_size=None, workers=None):
+    """Decrypt a file encrypted by HashCrypt.encrypt_file_inplace and remove its sidecar.
+
+    A partly encrypted file (interrupted encryption) is restored as well.
+    Decryption itself is not journaled.
+    """
+    if sidecar is None:
+        sidecar = path + SIDECAR_SUFFIX
+    with io.open(sidecar, "r+b") as f:
+        obj = read_header(f, key)
+        journal = InplaceJournal(f, f.tell())
+        end = None if journal.read() is None else journal.replay(path)
+    size = obj.aligned_buffer_size(buffer_size)
+    crypt_inplace(path, lambda chunks: obj.decrypt_chunks(chunks, workers=workers), size,
+                  end=end)
+    os.remove(sidecar)
+
+
+def append_to_file(path, key, data_stream, buffer_size=None, workers=None, pipeline_depth=None):
+    """Encrypt data_stream and append it to the CTR file at path.
+
+    The counter continues after the existing ciphertext, so only the new
+    bytes are encrypted. Returns the number of bytes appended.
+    """
+    with io.open(path, "r+b") as f:
+        crypt = read_header(f, key)
+        if type(crypt) is not CTR:
+            raise ValueError("Appending is only supported for CTR files", type(crypt).__name__)
+        data_offset = f.tell()
+        end = f.seek(0, io.SEEK_END)
+        counter, skip = divmod(end - data_offset, crypt.block_size)
+        if skip:
+            head = bytearray(crypt.block_size - skip)
+            n = readinto_full(data_stream, head)
+            f.write(crypt.encrypt_at(memoryview(head)[:n], end - data_offset))
+            if n < len(head):
+                return n
+            counter += 1
+        kwargs = {}
+        if pipeline_depth:
+            kwargs["pipeline_depth"] = pipeline_depth
+        crypt.encrypt_stream(data_stream, f, counter, buffer_size=buffer_size, workers=workers,
+                             **kwargs)
+        return f.tell() - end
+
+
+from hashcrypto.parallel import parallel_encrypt_file
+from hashcrypto.chunked import Chunked
+from hashcrypto.authenticated import Authenticated, AuthenticatedChunked
+from hashcrypto.compressed import Compressed
+from hashcrypto.cryptfile import open
+from hashcrypto.tuning import tune
+from hashcrypto.rekey import rekey_file
+from hashcrypto.kspool import KeystreamPool
+
+CONTAINERS["Chunked"] = Chunked
+CONTAINERS["Authenticated"] = Authenticated
+CONTAINERS["AuthenticatedChunked"] = AuthenticatedChunked
+CONTAINERS["Compressed"] = Compressed
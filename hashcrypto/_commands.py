@@ -1,10 +1,17 @@
 from __future__ import print_function, unicode_literals, absolute_import
 
 import hashcrypto
+from hashcrypto.compressed import CODECS
+from hashcrypto.parallel import default_workers
+from hashcrypto.stats import Stats
+from hashcrypto.tree import decrypt_tree, encrypt_tree
 import argparse
 import sys
 import binascii
 
+stdin = getattr(sys.stdin, "buffer", sys.stdin)
+stdout = getattr(sys.stdout, "buffer", sys.stdout)
+
 
 def plain_ascii(s):
     return s.encode("ascii")
@@ -15,51 +22,130 @@ encodings_in = {"hex": binascii.a2b_hex,
 encodings_out = {"hex": binascii.b2a_hex, "base64": binascii.b2a_base64}
 
 
-def add_enc_args(parser=argparse.ArgumentParser()):
-    parser = argparse.ArgumentParser()
+def add_common_args(parser):
+    parser.add_argument("--infile", "-i", type=argparse.FileType("rb"),
+                        default=stdin, help="Input file. Defaults to stdin.")
+    parser.add_argument("--outfile", "-o", type=argparse.FileType("wb"),
+                        default=stdout, help="Output file. Defaults to stdout.")
+    parser.add_argument("--stats", action="store_true", default=False,
+                        help="Print hashing, XOR and I/O statistics to stderr.")
+    parser.add_argument("--tree", nargs=2, metavar=("SRC", "DST"),
+                        help="Process every file below directory SRC into the same path below DST "
+                        "instead of infile/outfile. Existing files in DST are skipped.")
+    parser.add_argument("--workers", "-w", type=int,
+                        help="Worker processes for --tree. Defaults to the number of CPUs.")
+
+
+def tree_workers(ns):
+    if ns.workers is None:
+        return default_workers()
+    return ns.workers
+
+
+def tree_summary(summary, exit_func):
+    print(summary.report(), file=sys.stderr)
+    exit_func(1 if summary.failures else 0)
+
+
+def add_enc_args(parser=None):
+    if parser is None:
+        parser = argparse.ArgumentParser()
     parser.add_argument("mode", choices=hashcrypto.MODES.keys(),
                         help="Cipher mode.")
-    parser.add_argument("hash", choices=hashcrypto.fast_lookup,
-                        help="Hashing algorithm.")
+    parser.add_argument("hash", nargs="?", choices=sorted(hashcrypto.fast_lookup),
+                        help="Hashing algorithm. Defaults to the tuned one or {0} "
+                        "(sha512 for keys too long for a keyed hash).".format(
+                            hashcrypto.DEFAULT_HASH))
     parser.add_argument("key", help="Encryption/decryption key.")
+    parser.add_argument("--xof-length", type=int,
+                        help="Keystream bytes per hash call for shake_128/shake_256 (at most {1}). "
+                        "Defaults to {0}.".format(hashcrypto.DEFAULT_XOF_LENGTH, hashcrypto.MAX_XOF_LENGTH))
+    parser.add_argument("--append", metavar="FILE",
+                        help="Encrypt infile and append it to the existing CTR file FILE "
+                        "instead of writing outfile. Mode must be CTR, hash and nonce come from FILE.")
+    parser.add_argument("--compress", choices=sorted(CODECS),
+                        help="Compress the data before encrypting it.")
+    parser.add_argument("--mac", action="store_true", default=False,
+                        help="Append an HMAC of header and ciphertext, checked by hashdec.")
     group3 = parser.add_mutually_exclusive_group()
     group3.add_argument(
         "--iv", help="Initialization vector. Defaults to random bytes.")
     group3.add_argument("--nonce", help="Nonce. Defaults to random bytes.")
-    parser.add_argument("--infile", "-i", type=argparse.FileType("rb"),
-                        default=sys.stdin, help="Input file. Defaults to stdin.")
-    parser.add_argument("--outfile", "-o", type=argparse.FileType("rb"),
-                        default=sys.stdout, help="Input file. Defaults to stdout.")
+    add_common_args(parser)
+    parser.add_argument("--tune", action="store_true", default=False,
+                        help="Calibrate for this host, save the profile and exit. "
+                        "Takes no other arguments.")
     parser.add_argument("--verbose", "-v", action='store_true',
                         default=False, help="Verbose mode. Print more stuff to stderr.")
-    parser.add_argument("--encoding", "-e", choices=encodings_in, default=encodings_in["hex"],
+    parser.add_argument("--encoding", "-e", choices=encodings_in, default="hex",
                         help="Encoding for provided key, IV, nonce. Defaults to hex.")
     return parser
 
 
+def key_too_long(h, key):
+    """Return the key size limit of h if key exceeds it, else None."""
+    h = hashcrypto.lookup_hash(h)
+    if hashcrypto.is_keyed(h) and len(key) > h.MAX_KEY_SIZE:
+        return h.MAX_KEY_SIZE
+    return None
+
+
 def enc(namespace, error_func, exit_func):
     ns = namespace
-    e = ns.encoding
+    e = encodings_in[ns.encoding]
     cls = hashcrypto.MODES[ns.mode]
     key = e(ns.key)
-    if hasattr(ns, "iv"):
+    h = ns.hash or hashcrypto.tuned_setting("hash", hashcrypto.DEFAULT_HASH)
+    limit = key_too_long(h, key)
+    if limit is not None:
+        if ns.hash:
+            error_func("{0} takes keys of at most {1} bytes, choose another hash.".format(h, limit))
+            return
+        # like hashcrypto.default_hash
+        h = "sha512"
+    if ns.xof_length is not None:
+        if not isinstance(hashcrypto.fast_lookup[h], hashcrypto.XOF):
+            error_func("--xof-length is only supported for shake_128/shake_256.")
+            return
+        if not 0 < ns.xof_length <= hashcrypto.MAX_XOF_LENGTH:
+            error_func("--xof-length must be between 1 and {0}.".format(hashcrypto.MAX_XOF_LENGTH))
+            return
+        h = hashcrypto.XOF(h, ns.xof_length)
+    if ns.append:
+        if (cls is not hashcrypto.CTR or ns.mac or ns.compress or
+                ns.iv is not None or ns.nonce is not None):
+            error_func("--append requires mode CTR and no --mac, --compress, --iv or --nonce.")
+            return
+        hashcrypto.append_to_file(ns.append, key, ns.infile)
+        exit_func()
+        return
+    if ns.tree:
+        if ns.iv is not None or ns.nonce is not None:
+            error_func("--tree uses a fresh IV/nonce for every file.")
+            return
+        tree_summary(encrypt_tree(ns.tree[0], ns.tree[1], key, ns.mode, h, ns.mac,
+                                  tree_workers(ns), log=sys.stderr if ns.verbose else None,
+                                  compress=ns.compress),
+                     exit_func)
+        return
+    if ns.iv is not None:
         if issubclass(cls, hashcrypto.WithIV):
             start_iv = e(ns.iv)
-            crypt = cls(key, ns.algorithm, start_iv)
+            crypt = cls(key, h, start_iv)
         else:
             error_func(
                 "Initializaion vector was provided but is not supported by cipher mode.")
             return
-    elif hasattr(ns, "nonce"):
+    elif ns.nonce is not None:
         if issubclass(cls, hashcrypto.WithNonce):
             nonce = e(ns.nonce)
-            crypt = cls(key, ns.algorithm, nonce)
+            crypt = cls(key, h, nonce)
         else:
             error_func(
                 "Nonce was provided but is not supported by cipher mode.")
             return
     else:
-        crypt = cls(key, ns.algorithm)
+        crypt = cls(key, h)
         if ns.verbose:
             if isinstance(crypt, hashcrypto.WithIV):
                 print("IV:", file=sys.stderr)
@@ -69,31 +155,52 @@ def enc(namespace, error_func, exit_func):
                 print("Nonce:", file=sys.stderr)
                 for n, f in encodings_out.items():
                     print(n, f(crypt.nonce), file=sys.stderr)
-    crypt.encrypt_file(ns.infile, ns.outfile, write_header=True)
+    if ns.compress:
+        crypt = hashcrypto.Compressed(crypt, ns.compress)
+    if ns.mac:
+        crypt = hashcrypto.Authenticated(crypt)
+    if ns.stats:
+        crypt.stats = Stats()
+    crypt.encrypt_file(ns.infile, ns.outfile)
+    ns.outfile.flush()
+    if ns.stats:
+        print(crypt.stats.report(), file=sys.stderr)
     exit_func()
 
 
 def enc_main():
+    if sys.argv[1:2] == ["rekey"]:
+        sys.argv.pop(1)
+        return rekey_main()
+    if "--tune" in sys.argv[1:]:
+        from hashcrypto.tuning import main
+        main()
+        sys.exit()
     parser = add_enc_args()
     enc(parser.parse_args(), parser.error, parser.exit)
 
 
-def add_dec_args(parser=argparse.ArgumentParser()):
+def add_dec_args(parser=None):
+    if parser is None:
+        parser = argparse.ArgumentParser()
     parser.add_argument("key", help="Encryption/decryption key.")
-    parser.add_argument("--infile", "-i", type=argparse.FileType("rb"),
-                        default=sys.stdin, help="Input file. Defaults to stdin.")
-    parser.add_argument("--outfile", "-o", type=argparse.FileType("rb"),
-                        default=sys.stdout, help="Input file. Defaults to stdout.")
-    parser.add_argument("--encoding", "-e", choices=encodings_in, default=encodings_in["hex"],
+    add_common_args(parser)
+    parser.add_argument("--encoding", "-e", choices=encodings_in, default="hex",
                         help="Encoding for provided key. Defaults to hex.")
     return parser
 
 
 def dec(namespace, error_func, exit_func):
     ns = namespace
-    ns = parser.parse_args()
-    key = ns.encoding(ns.key)
-    hashcrypto.decrypt_file(ns.infile, ns.outfile, key)
+    key = encodings_in[ns.encoding](ns.key)
+    if ns.tree:
+        tree_summary(decrypt_tree(ns.tree[0], ns.tree[1], key, tree_workers(ns)), exit_func)
+        return
+    stats = Stats() if ns.stats else None
+    hashcrypto.decrypt_file(ns.infile, ns.outfile, key, stats=stats)
+    ns.outfile.flush()
+    if stats is not None:
+        print(stats.report(), file=sys.stderr)
     exit_func()
 
 
@@ -102,6 +209,46 @@ def dec_main():
     dec(parser.parse_args(), parser.error, parser.exit)
 
 
+def add_rekey_args(parser=None):
+    if parser is None:
+        parser = argparse.ArgumentParser(prog="hashenc rekey")
+    parser.add_argument("old_key", help="Current key.")
+    parser.add_argument("new_key", help="New key.")
+    parser.add_argument("--mode", choices=hashcrypto.MODES.keys(),
+                        help="New cipher mode. Defaults to the current one.")
+    parser.add_argument("--hash", choices=sorted(hashcrypto.fast_lookup),
+                        help="New hashing algorithm. Defaults to the current one.")
+    parser.add_argument("--infile", "-i", type=argparse.FileType("rb"),
+                        default=stdin, help="Input file. Defaults to stdin.")
+    parser.add_argument("--outfile", "-o", type=argparse.FileType("wb"),
+                        default=stdout, help="Output file. Defaults to stdout.")
+    parser.add_argument("--workers", "-w", type=int,
+                        help="Worker processes. Defaults to one.")
+    parser.add_argument("--encoding", "-e", choices=encodings_in, default="hex",
+                        help="Encoding for provided keys. Defaults to hex.")
+    return parser
+
+
+def rekey(namespace, error_func, exit_func):
+    ns = namespace
+    e = encodings_in[ns.encoding]
+    if ns.hash:
+        limit = key_too_long(ns.hash, e(ns.new_key))
+        if limit is not None:
+            error_func("{0} takes keys of at most {1} bytes, choose another hash.".format(
+                ns.hash, limit))
+            return
+    hashcrypto.rekey_file(ns.infile, ns.outfile, e(ns.old_key), e(ns.new_key), ns.mode, ns.hash,
+                          workers=ns.workers)
+    ns.outfile.flush()
+    exit_func()
+
+
+def rekey_main():
+    parser = add_rekey_args()
+    rekey(parser.parse_args(), parser.error, parser.exit)
+
+
 def main():
     if len(sys.argv) > 1:
         ed = sys.argv.pop(1).lower()
@@ -109,6 +256,8 @@ def main():
             enc_main()
         elif ed == "dec":
             dec_main()
+        elif ed == "rekey":
+            rekey_main()
     # quite hacky
     pe = add_enc_args()
     pe.parse_args(["--help"])
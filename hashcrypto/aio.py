@@ -0,0 +1,301 @@
+"""asyncio counterparts of the stream and file functions (Python 3.7+).
+
+reader is an asyncio.StreamReader (anything with an async readexactly),
+writer an asyncio.StreamWriter (write plus async drain). Chunks of at
+least OFFLOAD_SIZE bytes are encrypted in an executor so the event loop
+stays responsive; drain() is awaited after every chunk for backpressure.
+
+Authenticated and AuthenticatedChunked are verified like in the
+synchronous functions, including the chunk index; Compressed compresses
+and decompresses on the fly.
+"""
+import asyncio
+import io
+
+from hashcrypto import (MAGIC, Q, Authenticated, AuthenticatedChunked, AuthenticationError, Chunked,
+                        Compressed, lookup_format)
+from hashcrypto.authenticated import check_trailer
+from hashcrypto.chunked import INDEX_MAGIC
+from hashcrypto.compressed import READ_SIZE, decompress_pieces, lookup_codec
+
+OFFLOAD_SIZE = 64 * 1024
+
+
+async def aread_plus(reader):
+    size = (await reader.readexactly(1))[0]
+    if size >= 0xFF:
+        return await reader.readexactly(size) + await aread_plus(reader)
+    return await reader.readexactly(size)
+
+
+async def aread_header(reader, key):
+    """Async version of read_header."""
+    if await reader.readexactly(len(MAGIC)) != MAGIC:
+        raise ValueError("Bad Header")
+    ver = (await aread_plus(reader)).decode("ascii")
+    cls = lookup_format((await aread_plus(reader)).decode("ascii"))
+    fields = [await aread_plus(reader) for _ in range(cls.header_fields)]
+    return cls.from_header(key, fields)
+
+
+async def _read_upto(reader, size):
+    try:
+        return await reader.readexactly(size)
+    except asyncio.IncompleteReadError as e:
+        return e.partial
+
+
+class _Feed(object):
+    """Iterator handing out one chunk at a time to a *_chunks generator."""
+
+    def __init__(self):
+        self.item = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        item, self.item = self.item, None
+        if item is None:
+            raise StopIteration
+        return item
+
+
+async def _call(executor, func, *args):
+    return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+
+async def _run(executor, size, func, *args):
+    """Call func(*args), in executor if size is at least OFFLOAD_SIZE."""
+    if size >= OFFLOAD_SIZE:
+        return await _call(executor, func, *args)
+    return func(*args)
+
+
+class _MacWriter(object):
+    """Async writer updating mac with everything written."""
+
+    def __init__(self, writer, mac):
+        self.writer = writer
+        self.mac = mac
+
+    def write(self, b):
+        self.mac.update(b)
+        self.writer.write(b)
+
+    async def drain(self):
+        await self.writer.drain()
+
+
+class _MacReader(object):
+    """Async reader holding back the last tag_size bytes of reader and updating mac with the rest."""
+
+    def __init__(self, reader, mac, tag_size):
+        self.reader = reader
+        self.mac = mac
+        self.tag_size = tag_size
+        self.pending = bytearray()
+        self.eof = False
+
+    async def readexactly(self, n):
+        missing = n + self.tag_size - len(self.pending)
+        if missing > 0 and not self.eof:
+            data = await _read_upto(self.reader, missing)
+            self.eof = len(data) < missing
+            self.pending += data
+        size = max(min(n, len(self.pending) - self.tag_size), 0)
+        out = bytes(self.pending[:size])
+        del self.pending[:size]
+        self.mac.update(out)
+        if size < n:
+            raise asyncio.IncompleteReadError(out, n)
+        return out
+
+    async def verify(self):
+        """Consume the rest of reader and check the trailer."""
+        while len(await _read_upto(self, 64 * 1024)) == 64 * 1024:
+            pass
+        check_trailer(self.mac, self.pending, self.tag_size)
+
+
+async def _pump(process, chunks, writer, executor):
+    """Write process(chunk) for every chunk from the async iterator chunks."""
+    feed = _Feed()
+    results = process(feed)
+    try:
+        async for chunk in chunks:
+            feed.item = chunk
+            out = await _run(executor, len(chunk), next, results)
+            writer.write(out)
+            await writer.drain()
+    finally:
+        results.close()
+
+
+class _CompressingReader(object):
+    """Async reader returning the compressed content of reader."""
+
+    def __init__(self, reader, compressor, executor):
+        self.reader = reader
+        self.compressor = compressor
+        self.executor = executor
+        self.pending = bytearray()
+        self.eof = False
+
+    async def readexactly(self, n):
+        while not self.eof and len(self.pending) < n:
+            data = await _read_upto(self.reader, READ_SIZE)
+            if data:
+                self.pending += await _run(self.executor, len(data), self.compressor.compress, data)
+            if len(data) < READ_SIZE:
+                self.pending += self.compressor.flush()
+                self.eof = True
+        out = bytes(self.pending[:n])
+        del self.pending[:n]
+        if len(out) < n:
+            raise asyncio.IncompleteReadError(out, n)
+        return out
+
+
+class _DecompressingWriter(object):
+    """Async writer decompressing everything written to writer."""
+
+    def __init__(self, writer, decompressor, executor):
+        self.writer = writer
+        self.decompressor = decompressor
+        self.executor = executor
+        self.pending = []
+
+    def write(self, b):
+        self.pending.append(bytes(b))
+
+    async def drain(self):
+        data = b"".join(self.pending)
+        del self.pending[:]
+        pieces = decompress_pieces(self.decompressor, data)
+        while True:
+            piece = await _run(self.executor, len(data), next, pieces, None)
+            if piece is None:
+                break
+            self.writer.write(piece)
+            await self.writer.drain()
+        await self.writer.drain()
+
+    async def finish(self):
+        await self.drain()
+        if not self.decompressor.eof:
+            raise ValueError("Truncated compressed stream")
+
+
+async def _read_chunks(reader, size):
+    while True:
+        chunk = await _read_upto(reader, size)
+        if chunk:
+            yield chunk
+        if len(chunk) < size:
+            return
+
+
+async def _read_exactly(reader, size):
+    try:
+        return await reader.readexactly(size)
+    except asyncio.IncompleteReadError:
+        raise ValueError("Truncated chunked container")
+
+
+async def aencrypt_stream(crypt, reader, writer, *args, buffer_size=None, executor=None, **kwargs):
+    """Async version of crypt.encrypt_stream; workers and pipeline_depth are not supported."""
+    if isinstance(crypt, Authenticated):
+        mac = crypt.new_mac()
+        await aencrypt_stream(crypt.crypt, reader, _MacWriter(writer, mac), *args,
+                              buffer_size=buffer_size, executor=executor, **kwargs)
+        writer.write(mac.digest())
+        await writer.drain()
+        return
+    if isinstance(crypt, Compressed):
+        compressor = lookup_codec(crypt.codec)[0](crypt.level)
+        await aencrypt_stream(crypt.crypt, _CompressingReader(reader, compressor, executor), writer,
+                              *args, buffer_size=buffer_size, executor=executor, **kwargs)
+        return
+    if isinstance(crypt, Chunked):
+        await _aencrypt_chunked(crypt, reader, writer, executor)
+        return
+    size = crypt.aligned_buffer_size(buffer_size)
+    await _pump(lambda chunks: crypt.encrypt_chunks(chunks, *args, **kwargs),
+                _read_chunks(reader, size), writer, executor)
+
+
+async def adecrypt_stream(crypt, reader, writer, *args, buffer_size=None, executor=None, **kwargs):
+    """Async version of crypt.decrypt_stream; workers and pipeline_depth are not supported."""
+    if isinstance(crypt, Authenticated):
+        macreader = _MacReader(reader, crypt.new_mac(), crypt.tag_size)
+        await adecrypt_stream(crypt.crypt, macreader, writer, *args,
+                              buffer_size=buffer_size, executor=executor, **kwargs)
+        await macreader.verify()
+        return
+    if isinstance(crypt, Compressed):
+        out = _DecompressingWriter(writer, lookup_codec(crypt.codec)[1](), executor)
+        await adecrypt_stream(crypt.crypt, reader, out, *args,
+                              buffer_size=buffer_size, executor=executor, **kwargs)
+        await out.finish()
+        return
+    if isinstance(crypt, Chunked):
+        await _adecrypt_chunked(crypt, reader, writer, executor)
+        return
+    await _pump(lambda chunks: crypt.decrypt_chunks(chunks, *args, **kwargs),
+                _read_chunks(reader, crypt.aligned_buffer_size(buffer_size)), writer, executor)
+
+
+async def _aencrypt_chunked(container, reader, writer, executor):
+    offsets = []
+    pos = 0
+    index = 0
+    async for chunk in _read_chunks(reader, container.chunk_size):
+        out = await _run(executor, len(chunk), container.encrypt_chunk, chunk, index)
+        offsets.append(pos)
+        writer.write(Q.pack(len(out)))
+        writer.write(out)
+        await writer.drain()
+        pos += Q.size + len(out)
+        index += 1
+    pos += Q.size
+    writer.write(Q.pack(0) + container.index_bytes(offsets))
+    writer.write(Q.pack(pos) + INDEX_MAGIC)
+    await writer.drain()
+
+
+async def _adecrypt_chunked(container, reader, writer, executor):
+    offsets = []
+    pos = 0
+    index = 0
+    while True:
+        size = Q.unpack(await _read_exactly(reader, Q.size))[0]
+        if not size:
+            break
+        if size > container.max_record_size():
+            raise ValueError("Chunk record too long", size)
+        chunk = await _read_exactly(reader, size)
+        writer.write(await _run(executor, size, container.decrypt_chunk, chunk, index))
+        await writer.drain()
+        offsets.append(pos)
+        pos += Q.size + size
+        index += 1
+    if isinstance(container, AuthenticatedChunked):
+        count = await _read_exactly(reader, Q.size)
+        if Q.unpack(count)[0] != len(offsets):
+            raise AuthenticationError("Chunk index does not match the records")
+        rest = await _read_exactly(reader, len(offsets) * Q.size + container.tag_size)
+        if container.read_offsets(io.BytesIO(count + rest)) != offsets:
+            raise AuthenticationError("Chunk index does not match the records")
+
+
+async def aencrypt_file(crypt, reader, writer, *args, **kwargs):
+    """Async version of crypt.encrypt_file."""
+    writer.write(crypt.header())
+    await aencrypt_stream(crypt, reader, writer, *args, **kwargs)
+
+
+async def adecrypt_file(reader, writer, key, buffer_size=None, executor=None):
+    """Async version of decrypt_file."""
+    obj = await aread_header(reader, key)
+    await adecrypt_stream(obj, reader, writer, buffer_size=buffer_size, executor=executor)
@@ -0,0 +1,227 @@
+"""Encrypt-then-MAC containers.
+
+Authenticated wraps a mode object. The HMAC covers the inner header and
+the ciphertext; it is computed while encrypting and written as a trailer,
+and decrypt_stream verifies it in the same pass. As plaintext is written
+before the trailer is reached, output of a stream that fails verification
+must be discarded.
+
+AuthenticatedChunked adds an HMAC tag to every chunk record and to the
+index, so single chunks are verified when read, e.g. through
+hashcrypto.open.
+
+The MAC key is derived from the encryption key with HMAC-SHA256.
+"""
+from __future__ import absolute_import
+
+import hmac
+import hashlib
+import io
+
+from hashcrypto import (MAGIC, Q, AuthenticationError, __version__, counted_reads, lookup_hash,
+                        pack_plus, read_header, tuned_setting, write_chunks)
+from hashcrypto.chunked import DEFAULT_CHUNK_SIZE, Chunked, check_format_version, read_exactly
+
+DEFAULT_MAC_HASH = "sha256"
+MAC_KEY_LABEL = b"\0hashcrypto-mac"
+
+
+def derive_mac_key(key):
+    return hmac.new(bytes(key), MAC_KEY_LABEL, hashlib.sha256).digest()
+
+
+class _MacWriter(object):
+    """Write-through file updating mac with everything written."""
+
+    def __init__(self, raw, mac):
+        self.raw = raw
+        self.mac = mac
+
+    def write(self, b):
+        self.mac.update(b)
+        return self.raw.write(b)
+
+
+class _MacReader(io.RawIOBase):
+    """Reader holding back the last tag_size bytes of raw and updating mac with the rest."""
+
+    def __init__(self, raw, mac, tag_size):
+        self.raw = raw
+        self.mac = mac
+        self.tag_size = tag_size
+        self.pending = bytearray()
+        self.eof = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        want = len(b) + self.tag_size
+        while not self.eof and len(self.pending) < want:
+            data = self.raw.read(want - len(self.pending))
+            if data:
+                self.pending += data
+            else:
+                self.eof = True
+        n = max(min(len(b), len(self.pending) - self.tag_size), 0)
+        mv = memoryview(b)[:n]
+        mv[:] = self.pending[:n]
+        self.mac.update(mv)
+        del self.pending[:n]
+        return n
+
+    def verify(self):
+        """Consume the rest of raw and check the trailer."""
+        buffer = bytearray(64 * 1024)
+        while self.readinto(buffer):
+            pass
+        check_trailer(self.mac, self.pending, self.tag_size)
+
+
+def check_trailer(mac, trailer, tag_size):
+    """Raise AuthenticationError unless trailer is the digest of mac."""
+    if len(trailer) != tag_size:
+        raise AuthenticationError("Truncated authenticated stream")
+    if not hmac.compare_digest(bytes(trailer), mac.digest()):
+        raise AuthenticationError("MAC check failed")
+
+
+class Authenticated(object):
+    header_fields = 2
+
+    def __init__(self, crypt, mac_hash=DEFAULT_MAC_HASH, inner_header=None):
+        if inner_header is None:
+            inner_header = crypt.header()
+        self.crypt = crypt
+        self.mac_hash = mac_hash
+        self.inner_header = inner_header
+        self.mac_key = derive_mac_key(crypt.key)
+        self.tag_size = self.new_mac().digest_size
+
+    @property
+    def key(self):
+        return self.crypt.key
+
+    @property
+    def stats(self):
+        return self.crypt.stats
+
+    @stats.setter
+    def stats(self, stats):
+        self.crypt.stats = stats
+
+    def aligned_buffer_size(self, buffer_size=None):
+        return self.crypt.aligned_buffer_size(buffer_size)
+
+    def header(self):
+        fields = (__version__, self.__class__.__name__, self.mac_hash, self.inner_header)
+        return MAGIC + b"".join(pack_plus(f) for f in fields)
+
+    @classmethod
+    def from_header(cls, key, fields):
+        mac_hash, inner_header = fields
+        crypt = read_header(io.BytesIO(inner_header), key)
+        return cls(crypt, mac_hash.decode("ascii"), inner_header)
+
+    def new_mac(self):
+        """Return an HMAC already covering the header fields."""
+        mac = hmac.new(self.mac_key, digestmod=lookup_hash(self.mac_hash))
+        mac.update(pack_plus(self.mac_hash) + pack_plus(self.inner_header))
+        return mac
+
+    def encrypt_file(self, infile, outfile, *args, **kwargs):
+        outfile.write(self.header())
+        self.encrypt_stream(infile, outfile, *args, **kwargs)
+
+    def encrypt_stream(self, infile, outfile, *args, **kwargs):
+        """Encrypt like the inner object, then append the MAC."""
+        mac = self.new_mac()
+        self.crypt.encrypt_stream(infile, _MacWriter(outfile, mac), *args, **kwargs)
+        outfile.write(mac.digest())
+
+    def decrypt_stream(self, infile, outfile, *args, **kwargs):
+        """Decrypt like the inner object, raising AuthenticationError if the MAC does not match."""
+        reader = _MacReader(infile, self.new_mac(), self.tag_size)
+        self.crypt.decrypt_stream(reader, outfile, *args, **kwargs)
+        reader.verify()
+
+
+class AuthenticatedChunked(Chunked):
+    header_fields = 6
+
+    def __init__(self, key, hash_constructor=None, seed=None, mode="CTR",
+                 chunk_size=DEFAULT_CHUNK_SIZE, mac_hash=DEFAULT_MAC_HASH):
+        super(AuthenticatedChunked, self).__init__(key, hash_constructor, seed, mode, chunk_size)
+        self.mac_hash = mac_hash
+        self.mac_key = derive_mac_key(key)
+        self._tagged_header = self.header_fields_bytes()
+        self.tag_size = self.tag().digest_size
+
+    def header_fields_bytes(self):
+        fields = super(AuthenticatedChunked, self).header_fields_bytes()
+        return fields + pack_plus(self.mac_hash)
+
+    @classmethod
+    def from_header(cls, key, fields):
+        version, h, seed, mode, chunk_size, mac_hash = fields
+        check_format_version(version)
+        return cls(key, h.decode("ascii"), seed, mode.decode("ascii"), int(chunk_size),
+                   mac_hash.decode("ascii"))
+
+    def tag(self, *parts):
+        """Return an HMAC over the header (all of it but the version) and parts.
+
+        The header includes the seed, which binds the tags to this file.
+        """
+        mac = hmac.new(self.mac_key, digestmod=lookup_hash(self.mac_hash))
+        mac.update(self._tagged_header)
+        for part in parts:
+            mac.update(part)
+        return mac
+
+    def check(self, tag, what, *parts):
+        if not hmac.compare_digest(bytes(tag), self.tag(*parts).digest()):
+            raise AuthenticationError("MAC check failed", what)
+
+    def encrypt_chunk(self, data, index):
+        out = super(AuthenticatedChunked, self).encrypt_chunk(data, index)
+        return out + self.tag(Q.pack(index), out).digest()
+
+    def max_record_size(self):
+        return self.chunk_size + self.tag_size
+
+    def decrypt_chunk(self, data, index):
+        if len(data) < self.tag_size:
+            raise AuthenticationError("Truncated chunk", index)
+        mv = memoryview(data)
+        end = len(mv) - self.tag_size
+        self.check(mv[end:], index, Q.pack(index), mv[:end])
+        return super(AuthenticatedChunked, self).decrypt_chunk(mv[:end], index)
+
+    def index_bytes(self, offsets):
+        index = super(AuthenticatedChunked, self).index_bytes(offsets)
+        return index + self.tag(b"index", index).digest()
+
+    def read_offsets(self, f):
+        offsets = super(AuthenticatedChunked, self).read_offsets(f)
+        index = super(AuthenticatedChunked, self).index_bytes(offsets)
+        self.check(read_exactly(f, self.tag_size), "index", b"index", index)
+        return offsets
+
+    def decrypt_stream(self, infile, outfile, workers=None, buffer_size=None, pipeline_depth=None):
+        """Decrypt sequentially, checking every chunk and that the index matches the records."""
+        if workers is None:
+            workers = tuned_setting("workers")
+        offsets = []
+        pos = [0]
+
+        def records():
+            for data in self.read_records(infile):
+                offsets.append(pos[0])
+                pos[0] += Q.size + len(data)
+                yield data
+
+        chunks = counted_reads(records(), self.stats)
+        write_chunks(outfile, self.decrypt_chunks(chunks, workers), self.stats)
+        if self.read_offsets(infile) != offsets:
+            raise AuthenticationError("Chunk index does not match the records")
@@ -0,0 +1,217 @@
+"""Throughput benchmarks.
+
+Run ``python -m hashcrypto.bench --help`` for options. Results are printed
+(or written with --output) as JSON and can be compared against a saved
+baseline with --compare, which exits with status 1 on regressions.
+"""
+from __future__ import print_function, unicode_literals, absolute_import
+
+import argparse
+import io
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import hashcrypto
+import hashcrypto.xor
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+APIS = ("block", "buffer", "stream", "file")
+UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+def parse_size(s):
+    s = s.strip().upper().rstrip("B")
+    unit = s[-1:] if s[-1:] in UNITS else ""
+    return int(float(s[:len(s) - len(unit)]) * UNITS[unit])
+
+
+def parse_list(s):
+    return [x.strip() for x in s.split(",") if x.strip()]
+
+
+class ZeroReader(io.RawIOBase):
+    """Readable file of size zero bytes that needs no memory for its content."""
+
+    def __init__(self, size):
+        self.left = size
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = min(len(b), self.left)
+        b[:n] = b"\0" * n
+        self.left -= n
+        return n
+
+
+class NullWriter(io.RawIOBase):
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        return len(b)
+
+
+def make_crypt(mode, hash_name):
+    cls = hashcrypto.MODES[mode]
+    h = hashcrypto.lookup_hash(hash_name)
+    return cls(os.urandom(cls.suggest_key_size(h)), h)
+
+
+def run_block(crypt, size, workdir):
+    data = b"\0" * size
+    for _ in crypt.encrypt(hashcrypto.iter_blocks(data, crypt.block_size)):
+        pass
+
+
+def run_buffer(crypt, size, workdir):
+    crypt.encrypt_buffer(b"\0" * size)
+
+
+def run_stream(crypt, size, workdir):
+    crypt.encrypt_stream(ZeroReader(size), NullWriter())
+
+
+def run_file(crypt, size, workdir):
+    src = os.path.join(workdir, "plain")
+    if not os.path.exists(src) or os.path.getsize(src) != size:
+        with io.open(src, "wb") as f:
+            crypt.encrypt_stream(ZeroReader(size), f)
+    with io.open(src, "rb") as infile:
+        with io.open(os.path.join(workdir, "crypt"), "wb") as outfile:
+            crypt.encrypt_file(infile, outfile)
+
+RUNNERS = {"block": run_block, "buffer": run_buffer, "stream": run_stream, "file": run_file}
+
+
+clock = getattr(time, "perf_counter", time.time)
+
+
+def measure(func, repeat, memory):
+    best = None
+    for _ in range(repeat):
+        t = clock()
+        func()
+        t = clock() - t
+        if best is None or t < best:
+            best = t
+    peak = None
+    if memory and tracemalloc is not None:
+        tracemalloc.start()
+        try:
+            func()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return best, peak
+
+
+def run(modes, hashes, xors, apis, sizes, repeat=3, memory=True, log=None):
+    results = []
+    workdir = tempfile.mkdtemp(prefix="hashcrypto-bench-")
+    try:
+        for xor in xors:
+            hashcrypto.xor.set_backend(xor)
+            for mode in modes:
+                for hash_name in hashes:
+                    crypt = make_crypt(mode, hash_name)
+                    for api in apis:
+                        for size in sizes:
+                            seconds, peak = measure(
+                                lambda: RUNNERS[api](crypt, size, workdir), repeat, memory)
+                            r = {"mode": mode, "hash": hash_name, "xor": xor, "api": api,
+                                 "size": size, "seconds": seconds,
+                                 "mb_per_s": size / 1e6 / seconds if seconds else None,
+                                 "peak_bytes": peak}
+                            if log is not None:
+                                print("{mode} {hash} {xor} {api} {size}: {mb_per_s:.2f} MB/s".format(**r),
+                                      file=log)
+                            results.append(r)
+    finally:
+        hashcrypto.xor.set_backend()
+        for name in os.listdir(workdir):
+            os.remove(os.path.join(workdir, name))
+        os.rmdir(workdir)
+    return {"meta": {"hashcrypto": hashcrypto.__version__,
+                     "python": platform.python_version(),
+                     "implementation": platform.python_implementation(),
+                     "machine": platform.machine(),
+                     "platform": platform.platform()},
+            "results": results}
+
+
+def result_key(r):
+    return (r["mode"], r["hash"], r["xor"], r["api"], r["size"])
+
+
+def compare(report, baseline, threshold):
+    """Return the results more than threshold (fraction) slower than baseline."""
+    old = dict((result_key(r), r) for r in baseline["results"])
+    regressions = []
+    for r in report["results"]:
+        b = old.get(result_key(r))
+        if b is None or not b["mb_per_s"] or r["mb_per_s"] is None:
+            continue
+        change = r["mb_per_s"] / b["mb_per_s"] - 1
+        if change < -threshold:
+            regressions.append(dict(r, baseline_mb_per_s=b["mb_per_s"], change=change))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m hashcrypto.bench",
+                                     description="Measure hashcrypto throughput.")
+    parser.add_argument("--modes", type=parse_list, default=sorted(hashcrypto.MODES),
+                        help="Comma separated cipher modes. Defaults to all.")
+    parser.add_argument("--hashes", type=parse_list, default=sorted(hashcrypto.fast_lookup),
+                        help="Comma separated hash names. Defaults to fast_lookup.")
+    parser.add_argument("--xor", type=parse_list, default=hashcrypto.xor.available_backends(),
+                        help="Comma separated XOR backends. Defaults to all available.")
+    parser.add_argument("--apis", type=parse_list, default=list(APIS),
+                        help="Comma separated subset of {0}.".format(",".join(APIS)))
+    parser.add_argument("--sizes", type=lambda s: [parse_size(x) for x in parse_list(s)],
+                        default=[1024, 64 * 1024, 1024 * 1024],
+                        help="Comma separated payload sizes like 1K,1M,1G. Defaults to 1K,64K,1M.")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per measurement, best counts.")
+    parser.add_argument("--no-memory", dest="memory", action="store_false",
+                        help="Skip the extra tracemalloc run measuring peak memory.")
+    parser.add_argument("--output", "-o", help="Write the JSON report here instead of stdout.")
+    parser.add_argument("--compare", help="Baseline JSON report to compare against.")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="Relative slowdown counted as regression. Defaults to 0.1.")
+    parser.add_argument("--quiet", "-q", action="store_true", help="No progress on stderr.")
+    ns = parser.parse_args(argv)
+    for api in ns.apis:
+        if api not in RUNNERS:
+            parser.error("Unknown api {0}".format(api))
+
+    report = run(ns.modes, ns.hashes, ns.xor, ns.apis, ns.sizes, ns.repeat, ns.memory,
+                 None if ns.quiet else sys.stderr)
+    if ns.output:
+        with io.open(ns.output, "w") as f:
+            f.write(json.dumps(report, indent=1))
+    else:
+        print(json.dumps(report, indent=1))
+    if ns.compare:
+        with io.open(ns.compare) as f:
+            regressions = compare(report, json.load(f), ns.threshold)
+        for r in regressions:
+            print("REGRESSION {mode} {hash} {xor} {api} {size}: {mb_per_s:.2f} MB/s "
+                  "(baseline {baseline_mb_per_s:.2f}, {change:+.1%})".format(**r), file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,143 @@
+"""OFB keystream checkpoints for seeking into OFB ciphertext.
+
+Reaching block N of an OFB stream takes N hash calls from start_iv.
+Recording the register every interval blocks while encrypting (pass
+checkpoints=OFBCheckpoints(...) to OFB.encrypt_stream/encrypt_file) lets
+readers resume from the nearest checkpoint instead. OFBCheckpoints.create
+streams them to a sidecar file while encrypting.
+
+A register value reveals all keystream after it, so checkpoints are
+stored masked with a value derived from the key and the start_iv of the
+file. Using them needs the key, and a sidecar only fits the file it was
+written for, which load checks.
+"""
+from __future__ import absolute_import
+
+import hmac
+from collections import OrderedDict
+
+from hashcrypto import Q, op_xor
+
+DEFAULT_INTERVAL = 1024
+MAGIC = b"HCOFBCK2"
+MASK_PREFIX = b"\0hashcrypto-ofb-checkpoint"
+CHECK_LABEL = b"check"
+
+
+class OFBCheckpoints(object):
+    """Register values before every interval-th block.
+
+    Checkpoint j is the iv that OFB.keystream_into continues from to
+    produce keystream from block j * interval on. Checkpoint 0 is start_iv
+    and never stored. At most cache_size of them are kept in memory; the
+    others are read from the attached file (see create and load) or, without
+    one, dropped.
+    """
+
+    def __init__(self, interval=DEFAULT_INTERVAL, cache_size=4096):
+        if interval <= 0:
+            raise ValueError("interval must be positive", interval)
+        self.interval = interval
+        self.cache_size = cache_size
+        self.count = 0
+        self.dropped = False
+        self._states = OrderedDict()
+        self._file = None
+        self._crypt = None
+
+    @classmethod
+    def create(cls, f, crypt, interval=DEFAULT_INTERVAL, cache_size=4096):
+        """Write checkpoints recorded with crypt to the seekable binary file f as they are added."""
+        obj = cls(interval, cache_size)
+        f.write(MAGIC + Q.pack(interval) + Q.pack(0) + cls.check_value(crypt))
+        obj._file = f
+        obj._crypt = crypt
+        return obj
+
+    def add(self, j, state):
+        state = bytes(state)
+        if self._file is not None and j:
+            self._file.seek(self.offset(j))
+            self._file.write(op_xor(state, self.mask(self._crypt, j)))
+            if j >= self.count:
+                self._file.seek(len(MAGIC) + Q.size)
+                self._file.write(Q.pack(j + 1))
+        self.count = max(self.count, j + 1)
+        self._remember(j, state)
+
+    def _remember(self, j, state):
+        self._states.pop(j, None)
+        self._states[j] = state
+        while len(self._states) > self.cache_size:
+            self._states.popitem(last=False)
+            if self._file is None:
+                self.dropped = True
+
+    def offset(self, j):
+        """Position of checkpoint j in a checkpoint file."""
+        bs = self._crypt.block_size
+        return len(MAGIC) + 2 * Q.size + bs * j
+
+    def get(self, j):
+        """Return checkpoint j, or None if it is unknown."""
+        if j in self._states:
+            state = self._states.pop(j)
+            self._states[j] = state
+            return state
+        if self._file is None or not 0 < j < self.count:
+            return None
+        self._file.seek(self.offset(j))
+        state = op_xor(self._file.read(self._crypt.block_size), self.mask(self._crypt, j))
+        self._remember(j, state)
+        return state
+
+    def nearest(self, block_index):
+        """Return (j, state) of the last known checkpoint at or before block_index."""
+        j = min(block_index // self.interval, self.count - 1)
+        while j > 0:
+            state = self.get(j)
+            if state is not None:
+                return j, state
+            j -= 1
+        return 0, None
+
+    @staticmethod
+    def mask(crypt, j):
+        return crypt.block(MASK_PREFIX + crypt.start_iv + Q.pack(j))
+
+    @staticmethod
+    def check_value(crypt):
+        """Value stored in the checkpoint file to tie it to key and start_iv of crypt."""
+        return crypt.block(MASK_PREFIX + crypt.start_iv + CHECK_LABEL)
+
+    def save(self, f, crypt):
+        """Write all checkpoints recorded with crypt to the binary file f.
+
+        Only possible while all of them are in memory, use create to stream
+        them to a file instead.
+        """
+        if self.dropped:
+            raise ValueError("Checkpoints were dropped from memory, use OFBCheckpoints.create")
+        f.write(MAGIC + Q.pack(self.interval) + Q.pack(self.count) + self.check_value(crypt))
+        for j in range(1, self.count):
+            f.write(op_xor(self._states[j], self.mask(crypt, j)))
+
+    @classmethod
+    def load(cls, f, crypt, cache_size=4096):
+        """Attach to checkpoints saved for crypt in the seekable binary file f."""
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("Bad checkpoint file")
+        interval = Q.unpack(f.read(Q.size))[0]
+        obj = cls(interval, cache_size)
+        obj.count = Q.unpack(f.read(Q.size))[0]
+        if not hmac.compare_digest(f.read(crypt.block_size), cls.check_value(crypt)):
+            raise ValueError("Checkpoint file does not belong to this file or key")
+        obj._file = f
+        obj._crypt = crypt
+        return obj
+
+    def close(self):
+        """Close the file attached by load."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,239 @@
+"""Chunked container format.
+
+The plaintext is split into chunks of chunk_size bytes, each encrypted
+independently with its own iv/nonce derived from the key and the seed
+stored in the header. Chunks can therefore be processed in parallel and
+read in any order, for every mode in MODES.
+
+Layout after the header:
+
+* one record per chunk: Q length + ciphertext
+* a record of length 0 ending the chunk sequence
+* the index: Q chunk count + Q offset of every record
+* the footer: Q offset of the index + INDEX_MAGIC
+
+Offsets are relative to the end of the header. The header carries its own
+FORMAT_VERSION, checked when reading. Record lengths and chunk sizes read
+from a file are checked before anything is allocated for them.
+"""
+from __future__ import absolute_import
+
+import copy
+from os import urandom
+
+from hashcrypto import (B, Q, MAGIC, WithNonce, __version__, counted_reads, lookup_mode,
+                        pack_plus, read_chunks, readinto_full, tuned_setting, write_chunks)
+
+FORMAT_VERSION = 1
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+MAX_CHUNK_SIZE = 256 * 1024 * 1024
+# offsets per read of the index, bounds memory for an untrusted chunk count
+INDEX_READ_ENTRIES = 64 * 1024
+INDEX_MAGIC = b"HCINDEX\0"
+FOOTER_SIZE = Q.size + len(INDEX_MAGIC)
+DERIVE_PREFIX = b"\0hashcrypto-chunk"
+
+
+def read_exactly(f, size):
+    b = bytearray(size)
+    if readinto_full(f, b) != size:
+        raise ValueError("Truncated chunked container")
+    return b
+
+
+def check_format_version(version):
+    if version != str(FORMAT_VERSION).encode("ascii"):
+        raise ValueError("Unsupported chunked format version", version)
+
+
+class Chunked(object):
+    header_fields = 5
+
+    def __init__(self, key, hash_constructor=None, seed=None, mode="CTR",
+                 chunk_size=DEFAULT_CHUNK_SIZE):
+        if not isinstance(mode, type):
+            mode = lookup_mode(mode)
+        self.mode = mode
+        self.template = mode(key, hash_constructor, b"")
+        self.block_size = self.template.block_size
+        if chunk_size <= 0 or chunk_size % self.block_size:
+            raise ValueError("chunk_size must be a positive multiple of block_size",
+                             chunk_size, self.block_size)
+        if chunk_size > MAX_CHUNK_SIZE:
+            raise ValueError("chunk_size is too large", chunk_size, MAX_CHUNK_SIZE)
+        self.chunk_size = chunk_size
+        if seed is None:
+            seed = urandom(32)
+        self.seed = seed
+        if issubclass(mode, WithNonce):
+            self._iv_attr = "nonce"
+            self._iv_size = mode.suggest_nonce_size(self.template.hash)
+        else:
+            self._iv_attr = "start_iv"
+            self._iv_size = mode.suggest_iv_size(self.template.hash)
+
+    @property
+    def key(self):
+        return self.template.key
+
+    @property
+    def stats(self):
+        return self.template.stats
+
+    @stats.setter
+    def stats(self, stats):
+        self.template.stats = stats
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["template"] = copy.copy(self.template)
+        state["template"].stats = None
+        return state
+
+    def header(self):
+        return MAGIC + pack_plus(__version__) + self.header_fields_bytes()
+
+    def header_fields_bytes(self):
+        """Return the header after MAGIC and version."""
+        fields = (self.__class__.__name__, str(FORMAT_VERSION), self.template.hash_name(),
+                  self.seed, self.mode.__name__, str(self.chunk_size))
+        return b"".join(pack_plus(f) for f in fields)
+
+    @classmethod
+    def from_header(cls, key, fields):
+        version, h, seed, mode, chunk_size = fields
+        check_format_version(version)
+        return cls(key, h.decode("ascii"), seed, mode.decode("ascii"), int(chunk_size))
+
+    def chunk_iv(self, index):
+        """Derive the iv/nonce of chunk index from key and seed."""
+        parts = []
+        size = 0
+        j = 0
+        while size < self._iv_size:
+            d = self.template.block(DERIVE_PREFIX + self.seed + Q.pack(index) + B.pack(j))
+            parts.append(d)
+            size += len(d)
+            j += 1
+        return b"".join(parts)[:self._iv_size]
+
+    def chunk_crypt(self, index):
+        """Return the mode object encrypting chunk index."""
+        c = copy.copy(self.template)
+        setattr(c, self._iv_attr, self.chunk_iv(index))
+        return c
+
+    def encrypt_chunk(self, data, index):
+        return self.chunk_crypt(index).encrypt_buffer(data)
+
+    def decrypt_chunk(self, data, index):
+        return self.chunk_crypt(index).decrypt_buffer(data)
+
+    def encrypt_chunks(self, chunks, workers=None):
+        return self._map(self.encrypt_chunk, _encrypt_job, chunks, workers)
+
+    def decrypt_chunks(self, chunks, workers=None):
+        return self._map(self.decrypt_chunk, _decrypt_job, chunks, workers)
+
+    def _map(self, func, job, chunks, workers):
+        if workers is not None and workers > 1:
+            from hashcrypto.parallel import pool_map
+            jobs = ((self, bytes(c), i) for i, c in enumerate(chunks))
+            return pool_map(job, jobs, workers)
+        return (func(c, i) for i, c in enumerate(chunks))
+
+    def encrypt_file(self, infile, outfile, workers=None, buffer_size=None, pipeline_depth=None):
+        outfile.write(self.header())
+        self.encrypt_stream(infile, outfile, workers, buffer_size, pipeline_depth)
+
+    def encrypt_stream(self, infile, outfile, workers=None, buffer_size=None, pipeline_depth=None):
+        """Write chunk records, index and footer; buffer_size is ignored."""
+        if workers is None:
+            workers = tuned_setting("workers")
+        def process(chunks):
+            return self.records(self.encrypt_chunks(chunks, workers))
+
+        if pipeline_depth:
+            from hashcrypto.pipeline import run_pipeline
+            run_pipeline(process, infile, outfile, self.chunk_size, pipeline_depth, self.stats)
+            return
+        chunks = counted_reads(read_chunks(infile, self.chunk_size), self.stats)
+        write_chunks(outfile, process(chunks), self.stats)
+
+    def records(self, outputs):
+        """Yield the byte strings making up the file after the header."""
+        offsets = []
+        pos = 0
+        for out in outputs:
+            offsets.append(pos)
+            yield Q.pack(len(out))
+            yield out
+            pos += Q.size + len(out)
+        yield Q.pack(0)
+        pos += Q.size
+        yield self.index_bytes(offsets)
+        yield Q.pack(pos) + INDEX_MAGIC
+
+    def index_bytes(self, offsets):
+        return Q.pack(len(offsets)) + b"".join(Q.pack(o) for o in offsets)
+
+    def max_record_size(self):
+        """Largest valid record length."""
+        return self.chunk_size
+
+    def read_record_size(self, f):
+        size = Q.unpack(bytes(read_exactly(f, Q.size)))[0]
+        if size > self.max_record_size():
+            raise ValueError("Chunk record too long", size)
+        return size
+
+    def read_records(self, infile):
+        """Yield the ciphertext of every chunk record in infile, in order."""
+        while True:
+            size = self.read_record_size(infile)
+            if not size:
+                return
+            yield read_exactly(infile, size)
+
+    def decrypt_stream(self, infile, outfile, workers=None, buffer_size=None, pipeline_depth=None):
+        """Decrypt sequentially without using the index.
+
+        buffer_size and pipeline_depth are ignored, records are read whole.
+        """
+        if workers is None:
+            workers = tuned_setting("workers")
+        chunks = counted_reads(self.read_records(infile), self.stats)
+        write_chunks(outfile, self.decrypt_chunks(chunks, workers), self.stats)
+
+    def read_index(self, f, data_offset):
+        """Return the record offsets stored in the index of the seekable file f."""
+        f.seek(-FOOTER_SIZE, 2)
+        footer = bytes(read_exactly(f, FOOTER_SIZE))
+        if footer[Q.size:] != INDEX_MAGIC:
+            raise ValueError("Missing chunk index")
+        f.seek(data_offset + Q.unpack(footer[:Q.size])[0])
+        return self.read_offsets(f)
+
+    def read_offsets(self, f):
+        """Read an index as written by index_bytes from the current position of f."""
+        count = Q.unpack(bytes(read_exactly(f, Q.size)))[0]
+        offsets = []
+        while len(offsets) < count:
+            n = min(count - len(offsets), INDEX_READ_ENTRIES)
+            index = bytes(read_exactly(f, n * Q.size))
+            offsets.extend(Q.unpack_from(index, i * Q.size)[0] for i in range(n))
+        return offsets
+
+    def read_chunk(self, f, data_offset, offsets, index):
+        """Read and decrypt chunk index of the seekable file f."""
+        f.seek(data_offset + offsets[index])
+        size = self.read_record_size(f)
+        return self.decrypt_chunk(read_exactly(f, size), index)
+
+
+def _encrypt_job(container, data, index):
+    return container.encrypt_chunk(data, index)
+
+
+def _decrypt_job(container, data, index):
+    return container.decrypt_chunk(data, index)
@@ -0,0 +1,168 @@
+"""Compression ahead of encryption.
+
+Compressed wraps a mode object (or another container) and compresses the
+plaintext with one of CODECS while it streams into the inner object, so
+fewer keystream blocks are computed and fewer bytes written. The codec is
+recorded in the header; decrypt_stream decompresses on the fly.
+"""
+from __future__ import absolute_import
+
+import bz2
+import io
+import zlib
+
+from hashcrypto import MAGIC, __version__, pack_plus, read_header
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+
+def _zlib_compressor(level):
+    # level 1 is usually faster than hashing the bytes it saves
+    return zlib.compressobj(1 if level is None else level)
+
+
+def _bz2_compressor(level):
+    return bz2.BZ2Compressor(9 if level is None else level)
+
+
+# name: (compressor(level), decompressor())
+CODECS = {"zlib": (_zlib_compressor, zlib.decompressobj),
+          "bz2": (_bz2_compressor, bz2.BZ2Decompressor)}
+if lzma is not None:
+    CODECS["lzma"] = (lambda level: lzma.LZMACompressor(preset=level), lzma.LZMADecompressor)
+
+DEFAULT_CODEC = "zlib"
+READ_SIZE = 256 * 1024
+
+
+def decompress_pieces(decompressor, data, max_length=READ_SIZE):
+    """Yield the output of decompressor for data in pieces of at most max_length bytes.
+
+    Raises ValueError for data following the end of the compressed stream.
+    """
+    zlib_style = hasattr(decompressor, "unconsumed_tail")
+    while True:
+        if getattr(decompressor, "eof", False):
+            if data or decompressor.unused_data:
+                raise ValueError("Trailing data after compressed stream")
+            return
+        out = decompressor.decompress(data, max_length)
+        if out:
+            yield out
+        if zlib_style:
+            # zlib keeps the input it did not get to, more output may be pending
+            data = decompressor.unconsumed_tail
+            if not data and len(out) < max_length:
+                return
+        else:
+            data = b""
+            if decompressor.needs_input:
+                return
+
+
+def lookup_codec(name):
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError("Unknown or unavailable codec", name)
+
+
+class _CompressingReader(io.RawIOBase):
+    """Readable file returning the compressed content of raw."""
+
+    def __init__(self, raw, compressor):
+        self.raw = raw
+        self.compressor = compressor
+        self.pending = bytearray()
+        self.eof = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.eof and len(self.pending) < len(b):
+            data = self.raw.read(READ_SIZE)
+            if data:
+                self.pending += self.compressor.compress(data)
+            else:
+                self.pending += self.compressor.flush()
+                self.eof = True
+        n = min(len(b), len(self.pending))
+        memoryview(b)[:n] = self.pending[:n]
+        del self.pending[:n]
+        return n
+
+
+class _DecompressingWriter(object):
+    """Write-through file decompressing everything written to raw."""
+
+    def __init__(self, raw, decompressor):
+        self.raw = raw
+        self.decompressor = decompressor
+
+    def write(self, b):
+        for data in decompress_pieces(self.decompressor, bytes(b)):
+            self.raw.write(data)
+        return len(b)
+
+    def finish(self):
+        if not self.decompressor.eof:
+            raise ValueError("Truncated compressed stream")
+        if getattr(self.decompressor, "unused_data", b""):
+            raise ValueError("Trailing data after compressed stream")
+
+
+class Compressed(object):
+    header_fields = 2
+
+    def __init__(self, crypt, codec=DEFAULT_CODEC, level=None, inner_header=None):
+        lookup_codec(codec)
+        if inner_header is None:
+            inner_header = crypt.header()
+        self.crypt = crypt
+        self.codec = codec
+        self.level = level
+        self.inner_header = inner_header
+
+    @property
+    def key(self):
+        return self.crypt.key
+
+    @property
+    def stats(self):
+        return self.crypt.stats
+
+    @stats.setter
+    def stats(self, stats):
+        self.crypt.stats = stats
+
+    def aligned_buffer_size(self, buffer_size=None):
+        return self.crypt.aligned_buffer_size(buffer_size)
+
+    def header(self):
+        fields = (__version__, self.__class__.__name__, self.codec, self.inner_header)
+        return MAGIC + b"".join(pack_plus(f) for f in fields)
+
+    @classmethod
+    def from_header(cls, key, fields):
+        codec, inner_header = fields
+        crypt = read_header(io.BytesIO(inner_header), key)
+        return cls(crypt, codec.decode("ascii"), inner_header=inner_header)
+
+    def encrypt_file(self, infile, outfile, *args, **kwargs):
+        outfile.write(self.header())
+        self.encrypt_stream(infile, outfile, *args, **kwargs)
+
+    def encrypt_stream(self, infile, outfile, *args, **kwargs):
+        """Compress infile and encrypt the result like the inner object."""
+        reader = _CompressingReader(infile, lookup_codec(self.codec)[0](self.level))
+        self.crypt.encrypt_stream(reader, outfile, *args, **kwargs)
+
+    def decrypt_stream(self, infile, outfile, *args, **kwargs):
+        """Decrypt like the inner object and decompress the result."""
+        writer = _DecompressingWriter(outfile, lookup_codec(self.codec)[1]())
+        self.crypt.decrypt_stream(infile, writer, *args, **kwargs)
+        writer.finish()
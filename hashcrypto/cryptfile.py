@@ -0,0 +1,311 @@
+"""Seekable file objects on top of encrypted files."""
+from __future__ import absolute_import
+
+import io
+from collections import OrderedDict
+
+from hashcrypto import CTR, DEFAULT_BUFFER_SIZE, OFB, Q, read_header, readinto_full
+from hashcrypto.authenticated import AuthenticatedChunked
+from hashcrypto.checkpoints import OFBCheckpoints
+from hashcrypto.chunked import Chunked
+
+
+class CryptReader(io.RawIOBase):
+    """Raw, seekable, decrypting reader over the ciphertext part of a file.
+
+    raw must be a seekable binary file, data_offset is where the ciphertext starts.
+    Subclasses implement decrypt_at(data, offset) for modes whose ciphertext
+    offsets equal plaintext offsets, or override readinto_at and size.
+    """
+
+    def __init__(self, raw, crypt, data_offset, closefd=True):
+        super(CryptReader, self).__init__()
+        self.raw = raw
+        self.crypt = crypt
+        self.data_offset = data_offset
+        self.closefd = closefd
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def size(self):
+        return self.raw.seek(0, io.SEEK_END) - self.data_offset
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            pos += self._pos
+        elif whence == io.SEEK_END:
+            pos += self.size()
+        elif whence != io.SEEK_SET:
+            raise ValueError("Invalid whence", whence)
+        if pos < 0:
+            raise ValueError("Negative seek position", pos)
+        self._pos = pos
+        return pos
+
+    def readinto(self, b):
+        n = self.readinto_at(memoryview(b), self._pos)
+        self._pos += n
+        return n
+
+    def readinto_at(self, mv, pos):
+        self.raw.seek(self.data_offset + pos)
+        n = readinto_full(self.raw, mv)
+        if n:
+            mv[:n] = self.decrypt_at(mv[:n], pos)
+        return n
+
+    def decrypt_at(self, data, offset):
+        raise NotImplementedError
+
+    def close(self):
+        if not self.closed and self.closefd:
+            self.raw.close()
+        super(CryptReader, self).close()
+
+
+class CTRReader(CryptReader):
+
+    def decrypt_at(self, data, offset):
+        return self.crypt.decrypt_at(data, offset)
+
+
+class CTRFile(CTRReader):
+    """Readable and writable CTR file.
+
+    CTR XORs bytewise, so writes covering only part of a block need no
+    read-modify-write. The keystream of the last cache_size blocks used is
+    kept in an LRU cache; ranges longer than that bypass it. Writing past
+    the end fills the gap with encrypted zero bytes.
+    """
+
+    def __init__(self, raw, crypt, data_offset, closefd=True, cache_size=1024):
+        super(CTRFile, self).__init__(raw, crypt, data_offset, closefd)
+        self.cache_size = cache_size
+        self.blocks = OrderedDict()
+        self._prefix = crypt.prefix(crypt.nonce)
+
+    def writable(self):
+        return True
+
+    def keystream_block(self, counter):
+        ks = self.blocks.pop(counter, None)
+        if ks is None:
+            h = self._prefix.copy()
+            h.update(Q.pack(counter))
+            ks = h.digest(*self.crypt._digest_args)
+        self.blocks[counter] = ks
+        if len(self.blocks) > self.cache_size:
+            self.blocks.popitem(last=False)
+        return ks
+
+    def keystream_at(self, offset, size):
+        bs = self.crypt.block_size
+        first, skip = divmod(offset, bs)
+        end = -(-(offset + size) // bs)
+        if end - first > self.cache_size:
+            ks = bytearray(skip + size)
+            self.crypt.fill_keystream(ks, first)
+        else:
+            ks = b"".join(self.keystream_block(c) for c in range(first, end))
+        return memoryview(ks)[skip:skip + size]
+
+    def decrypt_at(self, data, offset):
+        return self.crypt.xor(data, self.keystream_at(offset, len(data)))
+
+    encrypt_at = decrypt_at
+
+    def _write_all(self, pos, data):
+        self.raw.seek(self.data_offset + pos)
+        mv = memoryview(data)
+        while mv:
+            n = self.raw.write(mv)
+            mv = mv[n:]
+
+    def _fill(self, start, stop):
+        """Write encrypted zeros (that is keystream) from start to stop."""
+        while start < stop:
+            n = min(stop - start, DEFAULT_BUFFER_SIZE)
+            self._write_all(start, self.keystream_at(start, n))
+            start += n
+
+    def write(self, b):
+        size = self.size()
+        if self._pos > size:
+            self._fill(size, self._pos)
+        n = len(memoryview(b))
+        self._write_all(self._pos, self.encrypt_at(b, self._pos))
+        self._pos += n
+        return n
+
+    def truncate(self, size=None):
+        if size is None:
+            size = self._pos
+        old = self.size()
+        if size > old:
+            self._fill(old, size)
+        else:
+            self.raw.truncate(self.data_offset + size)
+        return size
+
+    def flush(self):
+        super(CTRFile, self).flush()
+        if not self.raw.closed:
+            self.raw.flush()
+
+
+class OFBReader(CryptReader):
+    """Reader for OFB files.
+
+    Resumes the keystream from the nearest of the given checkpoints and
+    the last cache_size register values seen while reading. With
+    close_checkpoints, closing the reader also closes checkpoints.
+    """
+
+    def __init__(self, raw, crypt, data_offset, closefd=True, checkpoints=None,
+                 cache_size=1024, close_checkpoints=False):
+        super(OFBReader, self).__init__(raw, crypt, data_offset, closefd)
+        self.checkpoints = checkpoints
+        self.close_checkpoints = close_checkpoints
+        self.cache_size = cache_size
+        self.states = OrderedDict()
+
+    def close(self):
+        if not self.closed and self.close_checkpoints:
+            self.checkpoints.close()
+        super(OFBReader, self).close()
+
+    def remember(self, index, state):
+        self.states.pop(index, None)
+        self.states[index] = state
+        while len(self.states) > self.cache_size:
+            self.states.popitem(last=False)
+
+    def resume_point(self, index):
+        """Return (i, iv) with i <= index and iv the register before block i."""
+        best, iv = 0, self.crypt.start_iv
+        if self.checkpoints is not None:
+            j, state = self.checkpoints.nearest(index)
+            if state is not None:
+                best, iv = j * self.checkpoints.interval, state
+        for i, state in self.states.items():
+            if best < i <= index:
+                best, iv = i, state
+        return best, iv
+
+    def decrypt_at(self, data, offset):
+        bs = self.crypt.block_size
+        first, skip = divmod(offset, bs)
+        i, iv = self.resume_point(first)
+        block = self.crypt.block
+        while i < first:
+            iv = block(iv)
+            i += 1
+        self.remember(first, iv)
+        ks = bytearray(skip + len(data))
+        iv = self.crypt.fill_keystream(ks, iv)
+        self.remember(first + -(-len(ks) // bs), iv)
+        return self.crypt.xor(data, memoryview(ks)[skip:])
+
+
+class ChunkedReader(CryptReader):
+    """Reader for the Chunked container, decrypting only the chunks touched."""
+
+    def __init__(self, raw, crypt, data_offset, closefd=True):
+        super(ChunkedReader, self).__init__(raw, crypt, data_offset, closefd)
+        self.offsets = crypt.read_index(raw, data_offset)
+        self._cached = (None, b"")
+
+    def chunk(self, index):
+        if self._cached[0] != index:
+            data = self.crypt.read_chunk(self.raw, self.data_offset, self.offsets, index)
+            self._cached = (index, data)
+        return self._cached[1]
+
+    def size(self):
+        if not self.offsets:
+            return 0
+        last = len(self.offsets) - 1
+        return last * self.crypt.chunk_size + len(self.chunk(last))
+
+    def readinto_at(self, mv, pos):
+        cs = self.crypt.chunk_size
+        n = 0
+        while n < len(mv):
+            index, skip = divmod(pos + n, cs)
+            if index >= len(self.offsets):
+                break
+            data = self.chunk(index)[skip:skip + len(mv) - n]
+            if not data:
+                break
+            mv[n:n + len(data)] = data
+            n += len(data)
+        return n
+
+READERS = {CTR: CTRReader, OFB: OFBReader, Chunked: ChunkedReader,
+           AuthenticatedChunked: ChunkedReader}
+
+
+def open(file, key, buffering=-1, checkpoints=None, mode="r", cache_size=1024):
+    """Open an encrypted file for random-access reading, or reading and writing.
+
+    file is a path or a seekable binary file object positioned at the header.
+    mode "r+" opens an existing CTR file for writing as well (see CTRFile,
+    cache_size is its keystream cache size in blocks).
+    For OFB files, checkpoints may be an OFBCheckpoints object or the path
+    of a file written by OFBCheckpoints.create or save, which stays open until the
+    returned file is closed.
+    Returns a BufferedReader (BufferedRandom for "r+"), or the raw file if
+    buffering is 0.
+    """
+    if mode not in ("r", "r+"):
+        raise ValueError("Invalid mode", mode)
+    if hasattr(file, "read"):
+        raw, closefd = file, False
+    else:
+        raw, closefd = io.open(file, mode + "b", buffering=0), True
+    sidecar = None
+    try:
+        crypt = read_header(raw, key)
+        options = {}
+        if mode == "r+":
+            if type(crypt) is not CTR:
+                raise ValueError("Writing is only supported for CTR", type(crypt).__name__)
+            cls = CTRFile
+            options["cache_size"] = cache_size
+        else:
+            try:
+                cls = READERS[type(crypt)]
+            except KeyError:
+                raise ValueError("Random access is not supported for mode",
+                                 type(crypt).__name__)
+        if checkpoints is not None:
+            if cls is not OFBReader:
+                raise ValueError("Checkpoints are only supported for OFB")
+            if not isinstance(checkpoints, OFBCheckpoints):
+                # read lazily, closed together with the reader
+                sidecar = io.open(checkpoints, "rb")
+                checkpoints = OFBCheckpoints.load(sidecar, crypt)
+                options["close_checkpoints"] = True
+            options["checkpoints"] = checkpoints
+        reader = cls(raw, crypt, raw.tell(), closefd, **options)
+    except Exception:
+        if sidecar is not None:
+            sidecar.close()
+        if closefd:
+            raw.close()
+        raise
+    if buffering == 0:
+        return reader
+    if buffering < 0:
+        buffering = io.DEFAULT_BUFFER_SIZE
+    if mode == "r+":
+        return io.BufferedRandom(reader, buffering)
+    return io.BufferedReader(reader, buffering)
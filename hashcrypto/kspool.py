@@ -0,0 +1,128 @@
+"""Precomputed CTR keystream for low latency encryption of short messages.
+
+A KeystreamPool hands out consecutive counter ranges of a CTR object. A
+background thread keeps up to capacity bytes of keystream for the next
+counters in a ring buffer, so a reservation usually only copies keystream
+and the caller only pays for the XOR. Every counter is handed out at most
+once per pool; pools sharing a CTR object (same key and nonce) must use
+distinct counter ranges.
+"""
+from __future__ import absolute_import
+
+import threading
+
+from hashcrypto import CTR
+
+
+class KeystreamPool(object):
+
+    def __init__(self, crypt, capacity=1024 * 1024, batch_size=64 * 1024, counter_start=0,
+                 start=True):
+        if not isinstance(crypt, CTR):
+            raise TypeError("KeystreamPool needs a CTR instance", type(crypt).__name__)
+        self.crypt = crypt
+        bs = crypt.block_size
+        # sizes in blocks; capacity is the high-water mark of the ring
+        self.capacity = max(capacity // bs, 1)
+        self.batch = min(max(batch_size // bs, 1), self.capacity)
+        self.ring = bytearray(self.capacity * bs)
+        self.head = 0
+        self.filled = 0
+        self.next_counter = counter_start
+        self.hits = 0
+        self.misses = 0
+        self.blocks_inline = 0
+        self.closed = False
+        self.cond = threading.Condition(threading.Lock())
+        self.thread = threading.Thread(target=self._fill, name="hashcrypto-keystream-pool")
+        self.thread.daemon = True
+        if start:
+            self.thread.start()
+
+    def _copy_in(self, block, data):
+        bs = self.crypt.block_size
+        pos = block * bs
+        first = min(len(data), len(self.ring) - pos)
+        self.ring[pos:pos + first] = data[:first]
+        self.ring[:len(data) - first] = data[first:]
+
+    def _copy_out(self, block, n):
+        bs = self.crypt.block_size
+        pos = block * bs
+        end = pos + n * bs
+        if end <= len(self.ring):
+            return self.ring[pos:end]
+        return self.ring[pos:] + self.ring[:end - len(self.ring)]
+
+    def _fill(self):
+        bs = self.crypt.block_size
+        cond = self.cond
+        while True:
+            with cond:
+                while not self.closed and self.capacity - self.filled < self.batch:
+                    cond.wait()
+                if self.closed:
+                    return
+                counter = self.next_counter + self.filled
+            ks = bytearray(self.batch * bs)
+            self.crypt.keystream_into(ks, counter)
+            with cond:
+                # reservations that missed may have skipped past counter meanwhile
+                skip = self.next_counter + self.filled - counter
+                if skip < self.batch:
+                    tail = (self.head + self.filled) % self.capacity
+                    self._copy_in(tail, memoryview(ks)[skip * bs:])
+                    self.filled += self.batch - skip
+
+    def reserve(self, size):
+        """Return (counter, keystream) for size bytes; the counters used are never handed out again."""
+        bs = self.crypt.block_size
+        n = -(-size // bs)
+        with self.cond:
+            if self.closed:
+                raise ValueError("KeystreamPool is closed")
+            counter = self.next_counter
+            taken = min(n, self.filled)
+            ks = self._copy_out(self.head, taken)
+            self.head = (self.head + taken) % self.capacity
+            self.filled -= taken
+            self.next_counter += n
+            if taken == n:
+                self.hits += 1
+            else:
+                self.misses += 1
+                self.blocks_inline += n - taken
+            self.cond.notify()
+        if taken < n:
+            rest = bytearray((n - taken) * bs)
+            self.crypt.keystream_into(rest, counter + taken)
+            ks += rest
+        del ks[size:]
+        return counter, ks
+
+    def encrypt(self, data):
+        """Return (counter, ciphertext); decrypt with crypt.decrypt_buffer(ciphertext, counter)."""
+        counter, ks = self.reserve(len(data))
+        return counter, self.crypt.xor(data, ks)
+
+    def metrics(self):
+        with self.cond:
+            total = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits / float(total) if total else None,
+                    "blocks_inline": self.blocks_inline,
+                    "buffered_bytes": self.filled * self.crypt.block_size,
+                    "next_counter": self.next_counter}
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,138 @@
+"""Process pool helpers for modes whose blocks can be computed independently."""
+from __future__ import absolute_import
+
+import multiprocessing
+from collections import deque
+from itertools import chain, islice
+
+from hashcrypto import CTR, IVError, default_hash, tuned_setting
+
+
+def default_workers():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def imap_bounded(pool, func, jobs, depth):
+    """Like pool.imap, but with at most depth jobs in flight.
+
+    jobs is consumed lazily so memory stays bounded for large inputs.
+    """
+    pending = deque()
+    for job in jobs:
+        if len(pending) >= depth:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(func, job))
+    while pending:
+        yield pending.popleft().get()
+
+
+def pool_map(func, jobs, workers=None):
+    """Run func(*job) for every job on a process pool, yielding results in order.
+
+    A single job runs in this process, starting a pool would cost more.
+    """
+    jobs = iter(jobs)
+    first = list(islice(jobs, 2))
+    if len(first) < 2:
+        for job in first:
+            yield func(*job)
+        return
+    if workers is None:
+        workers = default_workers()
+    pool = multiprocessing.Pool(workers)
+    try:
+        for result in imap_bounded(pool, func, chain(first, jobs), 2 * workers):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _ctr_job(crypt, data, counter):
+    return crypt.encrypt_buffer(data, counter)
+
+
+def ctr_encrypt_chunks(crypt, chunks, counter_start=0, workers=None):
+    """Parallel version of CTR.encrypt_chunks, each chunk is one job."""
+    bs = crypt.block_size
+
+    def jobs():
+        counter = counter_start
+        for chunk in chunks:
+            yield (crypt, bytes(chunk), counter)
+            counter += len(chunk) // bs
+
+    return pool_map(_ctr_job, jobs(), workers)
+
+
+def _cfb_decrypt_job(crypt, data, iv):
+    return crypt.decrypt_buffer(data, iv)
+
+
+def cfb_decrypt_chunks(crypt, chunks, iv=None, workers=None):
+    """Parallel version of CFB.decrypt_chunks, each chunk is one job.
+
+    Every chunk only needs the last ciphertext block of its predecessor.
+    """
+    if iv is None:
+        iv = crypt.start_iv
+    if iv is None:
+        raise IVError(
+            "If iv is omitted or None, crypt.start_iv must be set.")
+    bs = crypt.block_size
+
+    def jobs():
+        prev = iv
+        for chunk in chunks:
+            data = bytes(chunk)
+            yield (crypt, data, prev)
+            prev = data[-bs:]
+
+    return pool_map(_cfb_decrypt_job, jobs(), workers)
+
+
+MANY_BATCH_SIZE = 4096
+
+
+def _batch_job(crypt, items, decrypt):
+    return crypt.crypt_batch(items, decrypt)
+
+
+def crypt_many(crypt, items, decrypt=False, workers=None, batch_size=MANY_BATCH_SIZE):
+    """Parallel version of encrypt_many/decrypt_many, batch_size messages per job."""
+    items = iter(items)
+
+    def jobs():
+        while True:
+            batch = [(bytes(iv), bytes(p)) for iv, p in islice(items, batch_size)]
+            if not batch:
+                return
+            yield (crypt, batch, decrypt)
+
+    parts = []
+    offsets = [0]
+    for data, batch_offsets in pool_map(_batch_job, jobs(), workers):
+        base = offsets[-1]
+        offsets.extend(base + o for o in batch_offsets[1:])
+        parts.append(data)
+    return b"".join(parts), offsets
+
+
+def parallel_encrypt_file(infile, outfile, key, hash_constructor=None,
+                          nonce=None, workers=None, buffer_size=None):
+    """Encrypt infile to outfile in CTR mode using a pool of workers processes.
+
+    The output is identical to CTR(key, hash_constructor, nonce).encrypt_file.
+    hash_constructor defaults to hashcrypto.default_hash(key).
+    """
+    if workers is None:
+        workers = tuned_setting("workers") or default_workers()
+    if hash_constructor is None:
+        hash_constructor = default_hash(key)
+    crypt = CTR(key, hash_constructor, nonce)
+    crypt.encrypt_file(infile, outfile, workers=workers, buffer_size=buffer_size)
+    return crypt
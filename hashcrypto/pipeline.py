@@ -0,0 +1,119 @@
+"""Overlapped reading, processing and writing of streams.
+
+A reader thread fills a fixed set of reusable buffers, the calling thread
+encrypts/decrypts them and a writer thread writes the results. Bounded
+queues of depth entries connect the stages, so at most depth input
+buffers and about depth results are held in memory.
+"""
+from __future__ import absolute_import
+
+import sys
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from hashcrypto import readinto_full
+from hashcrypto.stats import clock
+
+DEFAULT_DEPTH = 4
+
+_END = object()
+
+
+class _Failure(object):
+
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+
+def _reraise(failure):
+    raise failure.exc_info[1]
+
+
+def run_pipeline(process, infile, outfile, chunk_size, depth=DEFAULT_DEPTH, stats=None):
+    """Write process(chunks) to outfile, where chunks are read from infile.
+
+    process must consume each chunk before requesting the next one, like
+    the encrypt_chunks/decrypt_chunks methods do.
+    """
+    free = queue.Queue()
+    for _ in range(depth):
+        free.put(bytearray(chunk_size))
+    filled = queue.Queue(depth)
+    results = queue.Queue(depth)
+    stop = threading.Event()
+    write_failure = []
+
+    def reader():
+        try:
+            while not stop.is_set():
+                buf = free.get()
+                if buf is _END:
+                    return
+                t = clock()
+                n = readinto_full(infile, buf)
+                if stats is not None:
+                    stats.add("read", clock() - t, n)
+                if n:
+                    filled.put((buf, n))
+                if n < chunk_size:
+                    break
+        except Exception:
+            filled.put(_Failure(sys.exc_info()))
+            return
+        filled.put(_END)
+
+    def writer():
+        while True:
+            out = results.get()
+            if out is _END:
+                return
+            if write_failure:
+                continue
+            try:
+                if stats is None:
+                    outfile.write(out)
+                else:
+                    stats.write(outfile, out)
+            except Exception:
+                write_failure.append(_Failure(sys.exc_info()))
+
+    def chunks():
+        buf = None
+        while True:
+            if buf is not None:
+                free.put(buf)
+            item = filled.get()
+            if item is _END:
+                return
+            if isinstance(item, _Failure):
+                _reraise(item)
+            buf, n = item
+            yield memoryview(buf)[:n]
+
+    threads = [threading.Thread(target=reader), threading.Thread(target=writer)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    try:
+        for out in process(chunks()):
+            if write_failure:
+                break
+            results.put(out)
+    finally:
+        stop.set()
+        free.put(_END)
+        results.put(_END)
+        while threads[0].is_alive():
+            # unblock the reader if it waits for room in filled
+            try:
+                filled.get(timeout=0.01)
+            except queue.Empty:
+                pass
+        for t in threads:
+            t.join()
+    if write_failure:
+        _reraise(write_failure[0])
@@ -0,0 +1,75 @@
+"""Re-encryption of a file under a new key, mode or hash in one pass."""
+from __future__ import absolute_import
+
+from hashcrypto import (CTR, MODES, counted_reads, lookup_mode, read_chunks, read_header,
+                        write_chunks)
+
+
+def _gcd(a, b):
+    while b:
+        a, b = b, a % b
+    return a
+
+
+def rekey_chunks(old, new, chunks, offset=0):
+    """XOR CTR ciphertext chunks with the keystreams of old and new.
+
+    offset (the plaintext position of the first chunk) and all chunks but
+    the last must be multiples of both block sizes.
+    """
+    for chunk in chunks:
+        ks = bytearray(len(chunk))
+        old.fill_keystream(ks, offset // old.block_size)
+        ks2 = bytearray(len(chunk))
+        new.fill_keystream(ks2, offset // new.block_size)
+        yield new.xor(chunk, new.xor(ks, ks2))
+        offset += len(chunk)
+
+
+def _rekey_job(old, new, data, offset):
+    return next(rekey_chunks(old, new, [data], offset))
+
+
+def rekey_file(infile, outfile, old_key, new_key, new_mode=None, new_hash=None,
+               buffer_size=None, workers=None):
+    """Decrypt infile with old_key and write it to outfile encrypted with new_key.
+
+    new_mode and new_hash default to those of infile. Data is streamed in
+    chunks, so plaintext never reaches disk. If both sides are CTR, the
+    ciphertext is XORed with both keystreams and the plaintext is never
+    materialized; workers > 1 then spreads chunks over a process pool.
+    Returns the new mode object.
+    """
+    old = read_header(infile, old_key)
+    if type(old) not in MODES.values():
+        raise ValueError("Re-keying is only supported for plain modes", type(old).__name__)
+    if new_mode is None:
+        new_mode = type(old)
+    elif not isinstance(new_mode, type):
+        new_mode = lookup_mode(new_mode)
+    if new_hash is None:
+        new_hash = old.hash_name()
+    new = new_mode(new_key, new_hash)
+    outfile.write(new.header())
+    bs_old, bs_new = old.block_size, new.block_size
+    lcm = bs_old * bs_new // _gcd(bs_old, bs_new)
+    size = new.aligned_buffer_size(buffer_size)
+    size = max(size - size % lcm, lcm)
+    chunks = counted_reads(read_chunks(infile, size), new.stats)
+    if type(old) is CTR and type(new) is CTR:
+        if workers is not None and workers > 1:
+            from hashcrypto.parallel import pool_map
+
+            def jobs():
+                offset = 0
+                for chunk in chunks:
+                    yield (old, new, bytes(chunk), offset)
+                    offset += len(chunk)
+
+            out = pool_map(_rekey_job, jobs(), workers)
+        else:
+            out = rekey_chunks(old, new, chunks)
+    else:
+        out = new.encrypt_chunks(old.decrypt_chunks(chunks, workers=workers), workers=workers)
+    write_chunks(outfile, out, new.stats)
+    return new
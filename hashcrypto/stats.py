@@ -0,0 +1,75 @@
+"""Optional counters for the hot paths.
+
+Assign a Stats instance to the stats attribute of a HashCrypt (or Chunked)
+object to enable them. With stats left at None the instrumented code paths
+only pay one attribute check per chunk. Per-block APIs (encrypt, keystream,
+block) and work done in worker processes are not counted.
+"""
+from __future__ import print_function, unicode_literals, absolute_import
+
+import time
+
+clock = getattr(time, "perf_counter", time.time)
+
+STAGES = ("hash", "xor", "read", "write")
+
+
+class Stats(object):
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.reset()
+
+    def reset(self):
+        self.blocks_hashed = 0
+        self.bytes_xored = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.times = dict.fromkeys(STAGES, 0.0)
+
+    def add(self, stage, seconds, nbytes=0, blocks=0):
+        self.times[stage] += seconds
+        if stage == "hash":
+            self.blocks_hashed += blocks
+        elif stage == "xor":
+            self.bytes_xored += nbytes
+        elif stage == "read":
+            self.bytes_read += nbytes
+        else:
+            self.bytes_written += nbytes
+
+    def timed_reads(self, chunks):
+        """Wrap an iterable of chunks read from a file, counting bytes and time."""
+        chunks = iter(chunks)
+        while True:
+            t = clock()
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                self.add("read", clock() - t)
+                return
+            self.add("read", clock() - t, len(chunk))
+            yield chunk
+
+    def write(self, outfile, chunk):
+        t = clock()
+        outfile.write(chunk)
+        self.add("write", clock() - t, len(chunk))
+        if self.callback is not None:
+            self.callback(self)
+
+    def as_dict(self):
+        d = {"blocks_hashed": self.blocks_hashed, "bytes_xored": self.bytes_xored,
+             "bytes_read": self.bytes_read, "bytes_written": self.bytes_written}
+        for stage in STAGES:
+            d[stage + "_seconds"] = self.times[stage]
+        return d
+
+    def report(self):
+        lines = ["blocks hashed: {0}".format(self.blocks_hashed),
+                 "bytes xored:   {0}".format(self.bytes_xored),
+                 "bytes read:    {0}".format(self.bytes_read),
+                 "bytes written: {0}".format(self.bytes_written)]
+        for stage in STAGES:
+            lines.append("{0:<6} {1:10.4f} s".format(stage + ":", self.times[stage]))
+        return "\n".join(lines)
@@ -0,0 +1,165 @@
+"""Encryption and decryption of whole directory trees.
+
+Every file of src is written to the same relative path below dst, each
+encrypted file with its own header and fresh iv/nonce. Files are processed
+by a pool of worker processes; files smaller than SMALL_FILE_SIZE are
+grouped into batches to amortize the per-job overhead. Output goes to a
+temporary file next to its destination and is renamed when complete, so an
+interrupted run can simply be repeated: existing destinations are skipped.
+"""
+from __future__ import print_function, unicode_literals, absolute_import
+
+import io
+import os
+
+from hashcrypto import Authenticated, Compressed, decrypt_file, default_hash, lookup_mode
+from hashcrypto.compressed import lookup_codec
+from hashcrypto.stats import clock
+
+SMALL_FILE_SIZE = 256 * 1024
+BATCH_FILES = 64
+BATCH_SIZE = 4 * 1024 * 1024
+PART_SUFFIX = ".hcpart"
+
+
+class TreeSummary(object):
+
+    def __init__(self):
+        self.files = 0
+        self.skipped = 0
+        self.bytes_read = 0
+        self.failures = []
+        self.seconds = 0.0
+
+    def report(self):
+        lines = ["files:   {0}".format(self.files),
+                 "skipped: {0}".format(self.skipped),
+                 "failed:  {0}".format(len(self.failures)),
+                 "bytes:   {0}".format(self.bytes_read),
+                 "seconds: {0:.3f}".format(self.seconds)]
+        if self.seconds:
+            lines.append("MB/s:    {0:.2f}".format(self.bytes_read / 1e6 / self.seconds))
+        for path, error in self.failures:
+            lines.append("FAILED {0}: {1}".format(path, error))
+        return "\n".join(lines)
+
+
+def walk(src):
+    """Yield the relative path and size of every file below src, sorted per directory."""
+    for root, dirs, files in os.walk(src):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            yield os.path.relpath(path, src), os.path.getsize(path)
+
+
+def plan(files):
+    """Group (path, size) pairs into batches of paths, one batch per job."""
+    batch = []
+    batch_size = 0
+    for path, size in files:
+        if size >= SMALL_FILE_SIZE:
+            yield [path]
+            continue
+        batch.append(path)
+        batch_size += size
+        if len(batch) >= BATCH_FILES or batch_size >= BATCH_SIZE:
+            yield batch
+            batch = []
+            batch_size = 0
+    if batch:
+        yield batch
+
+
+def _crypt_one(spec, src, dst):
+    key, mode, hash_name, mac, compress, decrypt = spec
+    parent = os.path.dirname(dst)
+    if parent and not os.path.isdir(parent):
+        try:
+            os.makedirs(parent)
+        except OSError:
+            if not os.path.isdir(parent):
+                raise
+    part = dst + PART_SUFFIX
+    try:
+        with io.open(src, "rb") as infile:
+            with io.open(part, "wb") as outfile:
+                if decrypt:
+                    decrypt_file(infile, outfile, key, workers=1)
+                else:
+                    crypt = lookup_mode(mode)(key, hash_name)
+                    if compress:
+                        crypt = Compressed(crypt, compress)
+                    if mac:
+                        crypt = Authenticated(crypt)
+                    crypt.encrypt_file(infile, outfile, workers=1)
+        if os.path.exists(dst):
+            os.remove(dst)
+        os.rename(part, dst)
+    except BaseException:
+        if os.path.exists(part):
+            os.remove(part)
+        raise
+
+
+def _tree_job(spec, src, dst, paths):
+    results = []
+    for path in paths:
+        source = os.path.join(src, path)
+        try:
+            _crypt_one(spec, source, os.path.join(dst, path))
+        except Exception as e:
+            results.append((path, 0, "{0}: {1}".format(type(e).__name__, e)))
+        else:
+            results.append((path, os.path.getsize(source), None))
+    return results
+
+
+def crypt_tree(spec, src, dst, workers=None, overwrite=False, log=None):
+    summary = TreeSummary()
+    t = clock()
+    files = []
+    for path, size in walk(src):
+        if not overwrite and os.path.exists(os.path.join(dst, path)):
+            summary.skipped += 1
+        else:
+            files.append((path, size))
+    jobs = ((spec, src, dst, batch) for batch in plan(files))
+    if workers is not None and workers > 1:
+        from hashcrypto.parallel import pool_map
+        results = pool_map(_tree_job, jobs, workers)
+    else:
+        results = (_tree_job(*job) for job in jobs)
+    for batch in results:
+        for path, size, error in batch:
+            if error is None:
+                summary.files += 1
+                summary.bytes_read += size
+            else:
+                summary.failures.append((path, error))
+            if log is not None:
+                print(path if error is None else "FAILED {0}: {1}".format(path, error), file=log)
+    summary.seconds = clock() - t
+    return summary
+
+
+def encrypt_tree(src, dst, key, mode="CTR", hash_constructor=None, mac=False, workers=None,
+                 overwrite=False, log=None, compress=None):
+    """Encrypt every file below src to the same relative path below dst.
+
+    hash_constructor defaults to hashcrypto.default_hash(key), compress
+    names a codec of hashcrypto.compressed.CODECS. Returns a TreeSummary.
+    Files already present in dst are skipped unless overwrite is true.
+    """
+    if hash_constructor is None:
+        hash_constructor = default_hash(key)
+    hash_name = lookup_mode(mode)(key, hash_constructor).hash_name()
+    if compress:
+        lookup_codec(compress)
+    spec = (bytes(key), lookup_mode(mode).__name__, hash_name, mac, compress, False)
+    return crypt_tree(spec, src, dst, workers, overwrite, log)
+
+
+def decrypt_tree(src, dst, key, workers=None, overwrite=False, log=None):
+    """Decrypt a tree written by encrypt_tree, see there."""
+    return crypt_tree((bytes(key), None, None, False, None, True), src, dst, workers, overwrite, log)
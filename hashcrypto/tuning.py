@@ -0,0 +1,157 @@
+"""Host specific tuning of hash, buffer size, worker count and XOR backend.
+
+tune() runs short calibrations and saves the chosen profile to a cache
+file keyed by host name and Python version. Once such a profile exists it
+is used whenever a caller leaves the corresponding parameter unset. Set
+HASHCRYPTO_PROFILE to use another file, or HASHCRYPTO_NO_PROFILE=1 to
+ignore profiles.
+"""
+from __future__ import print_function, unicode_literals, absolute_import
+
+import io
+import json
+import os
+import platform
+import socket
+import sys
+
+from hashcrypto import xor
+
+# hashes considered by tune(), md5 and sha1 are deliberately left out
+CANDIDATE_HASHES = ("sha256", "sha512", "blake2b-keyed", "blake2s-keyed", "shake_128", "shake_256")
+CANDIDATE_BUFFER_SIZES = (256 * 1024, 1024 * 1024, 4 * 1024 * 1024, 16 * 1024 * 1024)
+
+_profile = None
+_loaded = False
+
+
+def profile_path():
+    if os.environ.get("HASHCRYPTO_PROFILE"):
+        return os.environ["HASHCRYPTO_PROFILE"]
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    name = "profile-{0}-{1}{2}.json".format(
+        socket.gethostname(), platform.python_implementation().lower(),
+        "".join(platform.python_version_tuple()[:2]))
+    return os.path.join(base, "hashcrypto", name)
+
+
+def load_profile():
+    """Return the cached profile of this host (or None), reading it at most once."""
+    global _profile, _loaded
+    if not _loaded:
+        _loaded = True
+        if os.environ.get("HASHCRYPTO_NO_PROFILE"):
+            return None
+        try:
+            with io.open(profile_path()) as f:
+                _profile = json.load(f)
+        except (IOError, OSError, ValueError):
+            _profile = None
+        else:
+            apply_profile(_profile)
+    return _profile
+
+
+def apply_profile(profile):
+    global _profile, _loaded
+    _profile, _loaded = profile, True
+    backend = profile.get("xor")
+    if backend in xor.backends and not os.environ.get("HASHCRYPTO_XOR"):
+        xor.set_backend(backend)
+
+
+def setting(name, default=None):
+    """Return the tuned value of name, or default without a profile."""
+    profile = load_profile()
+    if profile is None or profile.get(name) is None:
+        return default
+    return profile[name]
+
+
+def _throughput(func, size, clock, min_time):
+    n = 0
+    t = clock()
+    while True:
+        func()
+        n += 1
+        elapsed = clock() - t
+        if elapsed >= min_time:
+            return size * n / elapsed
+
+
+def tune(save=True, min_time=0.2, log=None):
+    """Calibrate on this host, optionally save, apply and return the profile."""
+    import hashcrypto
+    from hashcrypto.bench import NullWriter, ZeroReader
+    from hashcrypto.parallel import default_workers
+    from hashcrypto.stats import clock
+
+    def say(*args):
+        if log is not None:
+            print(*args, file=log)
+
+    size = 4 * 1024 * 1024
+    a = os.urandom(size)
+    b = os.urandom(size)
+    speeds = dict((name, _throughput(lambda: xor.backends[name](a, b), size, clock, min_time))
+                  for name in xor.available_backends() if name != "fallback")
+    backend = max(speeds, key=speeds.get)
+    say("xor:", backend, speeds)
+    xor.set_backend(backend)
+
+    speeds = {}
+    data = b"\0" * (1024 * 1024)
+    for name in CANDIDATE_HASHES:
+        if name not in hashcrypto.fast_lookup:
+            continue
+        crypt = hashcrypto.CTR(b"\0" * 32, name)
+        speeds[name] = _throughput(lambda: crypt.encrypt_buffer(data), len(data), clock, min_time)
+    hash_name = max(speeds, key=speeds.get)
+    say("hash:", hash_name, speeds)
+
+    crypt = hashcrypto.CTR(b"\0" * 32, hash_name)
+    speeds = {}
+    for buffer_size in CANDIDATE_BUFFER_SIZES:
+        total = 2 * buffer_size
+        speeds[buffer_size] = _throughput(
+            lambda: crypt.encrypt_stream(ZeroReader(total), NullWriter(),
+                                         buffer_size=buffer_size, workers=1),
+            total, clock, min_time)
+    buffer_size = max(speeds, key=speeds.get)
+    say("buffer_size:", buffer_size, speeds)
+
+    workers = 1
+    cpus = default_workers()
+    if cpus > 1:
+        speeds = {1: speeds[buffer_size]}
+        total = 4 * cpus * buffer_size
+        for w in sorted(set((2, max(cpus // 2, 2), cpus))):
+            speeds[w] = _throughput(
+                lambda: crypt.encrypt_stream(ZeroReader(total), NullWriter(),
+                                             buffer_size=buffer_size, workers=w),
+                total, clock, 0)
+        workers = max(speeds, key=speeds.get)
+        say("workers:", workers, speeds)
+
+    profile = {"hash": hash_name, "buffer_size": buffer_size, "workers": workers,
+               "xor": backend, "host": socket.gethostname(),
+               "python": platform.python_implementation() + " " + platform.python_version(),
+               "hashcrypto": hashcrypto.__version__}
+    if save:
+        path = profile_path()
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with io.open(path, "w") as f:
+            f.write(json.dumps(profile, indent=1, sort_keys=True))
+        say("saved to", path)
+    apply_profile(profile)
+    return profile
+
+
+def main():
+    profile = tune(log=sys.stderr)
+    print(json.dumps(profile, indent=1, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
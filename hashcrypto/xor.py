@@ -0,0 +1,110 @@
+"""Selectable implementations of op_xor.
+
+Every backend XORs two bytes-like objects of arbitrary length (whole
+multi-block buffers included) and returns bytes as long as the shorter
+input, matching bytesop.op_xor. The backend can be forced with
+set_backend() or the HASHCRYPTO_XOR environment variable.
+"""
+from __future__ import absolute_import
+
+import binascii
+import os
+import sys
+
+from hashcrypto import bytesop_fallback
+
+if sys.version_info >= (3, 0):
+    def xor_int(a, b):
+        """XOR two bytes-like objects via Python integers."""
+        n = min(len(a), len(b))
+        if len(a) != n:
+            a = memoryview(a)[:n]
+        if len(b) != n:
+            b = memoryview(b)[:n]
+        x = int.from_bytes(a, "little") ^ int.from_bytes(b, "little")
+        return x.to_bytes(n, "little")
+else:
+    def xor_int(a, b):
+        """XOR two bytes-like objects via Python integers."""
+        n = min(len(a), len(b))
+        if not n:
+            return b""
+        a = bytes(bytearray(a[:n]))
+        b = bytes(bytearray(b[:n]))
+        x = int(binascii.hexlify(a), 16) ^ int(binascii.hexlify(b), 16)
+        return binascii.unhexlify("%0*x" % (2 * n, x))
+
+backends = {"fallback": bytesop_fallback.op_xor, "int": xor_int}
+
+try:
+    import bytesop
+except ImportError:
+    pass
+else:
+    backends["bytesop"] = bytesop.op_xor
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+else:
+    def xor_numpy(a, b):
+        """XOR two bytes-like objects via numpy arrays."""
+        n = min(len(a), len(b))
+        x = numpy.frombuffer(a, numpy.uint8, n)
+        y = numpy.frombuffer(b, numpy.uint8, n)
+        return numpy.bitwise_xor(x, y).tobytes()
+
+    backends["numpy"] = xor_numpy
+
+# inputs at least this long go to numpy when the "auto" backend is active
+NUMPY_THRESHOLD = 4096
+
+
+def xor_auto(a, b):
+    """XOR two bytes-like objects with the fastest backend for their size."""
+    if len(a) >= NUMPY_THRESHOLD and len(b) >= NUMPY_THRESHOLD:
+        return xor_numpy(a, b)
+    return xor_int(a, b)
+
+if "bytesop" in backends:
+    _default = "bytesop"
+elif numpy is not None:
+    backends["auto"] = xor_auto
+    _default = "auto"
+else:
+    _default = "int"
+
+_name = _default
+_impl = backends[_default]
+
+
+def available_backends():
+    """Return the names of all usable backends."""
+    return sorted(backends)
+
+
+def get_backend():
+    """Return the name of the backend op_xor currently dispatches to."""
+    return _name
+
+
+def set_backend(name=None):
+    """Make op_xor use backend name, or the default one if name is None."""
+    global _name, _impl
+    if name is None:
+        name = _default
+    try:
+        impl = backends[name]
+    except KeyError:
+        raise ValueError("Unknown or unavailable XOR backend", name)
+    _name, _impl = name, impl
+
+
+if os.environ.get("HASHCRYPTO_XOR"):
+    set_backend(os.environ["HASHCRYPTO_XOR"])
+
+
+def op_xor(a, b):
+    """XOR two bytes-like objects with the selected backend."""
+    return _impl(a, b)
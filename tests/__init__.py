@@ -0,0 +1,8 @@
+import os
+
+# keep the suite independent of a tuning profile saved on this host
+os.environ["HASHCRYPTO_NO_PROFILE"] = "1"
+
+from hashcrypto import tuning  # noqa: E402
+
+tuning._profile, tuning._loaded = None, False
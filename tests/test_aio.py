@@ -0,0 +1,137 @@
+import asyncio
+import io
+import unittest
+
+import hashcrypto
+import hashcrypto.aio
+import hashcrypto.chunked
+import hashcrypto.compressed
+
+
+class Writer(object):
+
+    def __init__(self):
+        self.buffer = io.BytesIO()
+        self.drained = 0
+
+    def write(self, b):
+        self.buffer.write(b)
+
+    async def drain(self):
+        self.drained += 1
+
+
+def reader_for(data):
+    reader = asyncio.StreamReader()
+    reader.feed_data(data)
+    reader.feed_eof()
+    return reader
+
+
+class TestAsync(unittest.TestCase):
+
+    def roundtrip(self, crypt, key, data):
+        async def run():
+            cryptfile = Writer()
+            await hashcrypto.aio.aencrypt_file(crypt, reader_for(data), cryptfile, buffer_size=100)
+            expected = io.BytesIO()
+            crypt.encrypt_file(io.BytesIO(data), expected)
+            self.assertEqual(expected.getvalue(), cryptfile.buffer.getvalue())
+            outfile = Writer()
+            await hashcrypto.aio.adecrypt_file(reader_for(cryptfile.buffer.getvalue()), outfile, key)
+            self.assertEqual(data, outfile.buffer.getvalue())
+            self.assertTrue(outfile.drained)
+
+        asyncio.run(run())
+
+    def test_roundtrip(self):
+        key = bytes(range(20))
+        data = bytes(i & 0xFF for i in range(3000)) * 30
+        for cls in hashcrypto.MODES.values():
+            self.roundtrip(cls(key), key, data)
+        self.roundtrip(hashcrypto.Chunked(key, chunk_size=512), key, data)
+
+    def decrypt(self, ciphertext, key):
+        async def run():
+            outfile = Writer()
+            await hashcrypto.aio.adecrypt_file(reader_for(ciphertext), outfile, key)
+            return outfile.buffer.getvalue()
+
+        return asyncio.run(run())
+
+    def test_authenticated(self):
+        key = bytes(range(20))
+        data = bytes(i & 0xFF for i in range(3000)) * 30
+        for crypt in (hashcrypto.Authenticated(hashcrypto.CTR(key)),
+                      hashcrypto.Authenticated(hashcrypto.CFB(key)),
+                      hashcrypto.AuthenticatedChunked(key, chunk_size=512)):
+            self.roundtrip(crypt, key, data)
+            ciphertext = io.BytesIO()
+            crypt.encrypt_file(io.BytesIO(data), ciphertext)
+            ciphertext = bytearray(ciphertext.getvalue())
+            ciphertext[len(crypt.header()) + 1000] ^= 1
+            self.assertRaises(hashcrypto.AuthenticationError, self.decrypt, bytes(ciphertext), key)
+
+    def test_compressed(self):
+        key = bytes(range(20))
+        data = b"log line 1234\n" * 50000
+        for codec in sorted(hashcrypto.compressed.CODECS):
+            self.roundtrip(hashcrypto.Compressed(hashcrypto.CTR(key), codec), key, data)
+        self.roundtrip(hashcrypto.Authenticated(hashcrypto.Compressed(hashcrypto.OFB(key))), key, data)
+        self.roundtrip(hashcrypto.Compressed(hashcrypto.Chunked(key, chunk_size=512)), key, data)
+        ciphertext = io.BytesIO()
+        crypt = hashcrypto.Compressed(hashcrypto.CTR(key))
+        crypt.encrypt_file(io.BytesIO(data), ciphertext)
+        self.assertRaises(ValueError, self.decrypt, ciphertext.getvalue()[:-10], key)
+
+    def test_compressed_bounded(self):
+        key = bytes(range(20))
+        ciphertext = io.BytesIO()
+        hashcrypto.Compressed(hashcrypto.CTR(key)).encrypt_file(io.BytesIO(bytes(8 << 20)), ciphertext)
+        sizes = []
+
+        async def run():
+            outfile = Writer()
+            outfile.write = lambda b: sizes.append(len(b))
+            await hashcrypto.aio.adecrypt_file(reader_for(ciphertext.getvalue()), outfile, key)
+
+        asyncio.run(run())
+        self.assertEqual(8 << 20, sum(sizes))
+        self.assertLessEqual(max(sizes), hashcrypto.compressed.READ_SIZE)
+
+    def test_authenticated_truncated(self):
+        key = bytes(range(20))
+        data = bytes(i & 0xFF for i in range(3000))
+        ciphertext = io.BytesIO()
+        hashcrypto.Authenticated(hashcrypto.CTR(key)).encrypt_file(io.BytesIO(data), ciphertext)
+        self.assertRaises(hashcrypto.AuthenticationError, self.decrypt, ciphertext.getvalue()[:-1], key)
+        container = hashcrypto.AuthenticatedChunked(key, chunk_size=512)
+        ciphertext = io.BytesIO()
+        container.encrypt_file(io.BytesIO(data), ciphertext)
+        ciphertext = ciphertext.getvalue()
+        end = len(container.header())
+        while ciphertext[end:end + hashcrypto.Q.size] != hashcrypto.Q.pack(0):
+            end += hashcrypto.Q.size + hashcrypto.Q.unpack(ciphertext[end:end + hashcrypto.Q.size])[0]
+        end += hashcrypto.Q.size
+        for size in (end, end + hashcrypto.Q.size, len(ciphertext) - 30):
+            self.assertRaises(ValueError, self.decrypt, ciphertext[:size], key)
+
+    def test_authenticated_record_size(self):
+        key = bytes(range(20))
+        container = hashcrypto.AuthenticatedChunked(key, chunk_size=512)
+        ciphertext = io.BytesIO()
+        container.encrypt_file(io.BytesIO(bytes(3000)), ciphertext)
+        record = hashcrypto.Q.pack(512 + container.tag_size)
+        for size in (513 + container.tag_size, 2 ** 63):
+            changed = ciphertext.getvalue().replace(record, hashcrypto.Q.pack(size), 1)
+            with self.assertRaises(ValueError) as cm:
+                self.decrypt(changed, key)
+            self.assertEqual("Chunk record too long", cm.exception.args[0])
+        # an index count that does not match the records is rejected before reading the index
+        end = len(ciphertext.getvalue()) - hashcrypto.Q.size - len(hashcrypto.chunked.INDEX_MAGIC)
+        start = end - container.tag_size - 6 * hashcrypto.Q.size - hashcrypto.Q.size
+        changed = ciphertext.getvalue()[:start] + hashcrypto.Q.pack(2 ** 40) + ciphertext.getvalue()[start + 8:]
+        self.assertRaises(hashcrypto.AuthenticationError, self.decrypt, changed, key)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,21 @@
+import unittest
+import hashcrypto.bench
+
+
+class TestBench(unittest.TestCase):
+
+    def test_parse_size(self):
+        self.assertEqual(1024, hashcrypto.bench.parse_size("1K"))
+        self.assertEqual(3 * 1024 ** 3, hashcrypto.bench.parse_size("3gb"))
+        self.assertEqual(100, hashcrypto.bench.parse_size("100"))
+
+    def test_run_and_compare(self):
+        report = hashcrypto.bench.run(["CTR", "CFB"], ["sha256"], ["int"],
+                                      list(hashcrypto.bench.APIS), [1000], repeat=1)
+        self.assertEqual(8, len(report["results"]))
+        self.assertEqual([], hashcrypto.bench.compare(report, report, 0.1))
+        slower = {"results": [dict(r, mb_per_s=r["mb_per_s"] / 2) for r in report["results"]]}
+        self.assertEqual(8, len(hashcrypto.bench.compare(slower, report, 0.1)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,10 +3,20 @@ from __future__ import print_function, unicode_literals
 import unittest
 import hashcrypto
 import io
+from hashcrypto import Q
 
 def notrandom(n,start=0):
     return bytearray(0xff&i for i in range(start,start+n))
 
+class ShortReader(io.RawIOBase):
+    """Returns at most 7 bytes per call, like a slow pipe."""
+    def __init__(self,data):
+        self.data=io.BytesIO(data)
+    def readable(self):
+        return True
+    def readinto(self,b):
+        return self.data.readinto(memoryview(b)[:7])
+
 class TestCipherModes(unittest.TestCase):
     def setUp(self):
         self.inbytes=notrandom(1000)
@@ -32,6 +42,24 @@ class TestCipherModes(unittest.TestCase):
         hashcrypto.decrypt_file(cryptfile,outfile,self.key)
         self.assertEqual(infile.getvalue(),outfile.getvalue())
         
+    def chunked_matches_blockwise(self,cls):
+        crypt=cls(self.key)
+        bs=crypt.block_size
+        data=bytes(self.inbytes)
+        blocks=(data[i:i+bs] for i in range(0,len(data),bs))
+        expected=b"".join(crypt.encrypt(blocks))
+        for buffer_size in (1,bs*2,bs*3+5,None):
+            cryptfile=io.BytesIO()
+            crypt.encrypt_stream(ShortReader(data),cryptfile,buffer_size=buffer_size)
+            self.assertEqual(expected,cryptfile.getvalue())
+            outfile=io.BytesIO()
+            crypt.decrypt_stream(ShortReader(expected),outfile,buffer_size=buffer_size)
+            self.assertEqual(data,outfile.getvalue())
+
+    def test_chunked_matches_blockwise(self):
+        for cls in hashcrypto.MODES.values():
+            self.chunked_matches_blockwise(cls)
+
     def test_CTR_roundtrip_stream(self):
         self.roundtrip_stream(hashcrypto.CTR)
         
@@ -51,5 +79,771 @@ class TestCipherModes(unittest.TestCase):
         self.roundtrip_file(hashcrypto.OFB)
 
 
+class TestPrefixState(unittest.TestCase):
+    def test_block_matches_rehash(self):
+        key=bytes(notrandom(20))
+        for name,h in hashcrypto.fast_lookup.items():
+            crypt=hashcrypto.CTR(key,h)
+            ks=crypt.keystream(5)
+            for counter in range(5,9):
+                data=crypt.nonce+hashcrypto.Q.pack(counter)
+                if name in hashcrypto.keyed_lookup:
+                    expected=h(data,key=key).digest()
+                elif isinstance(h,hashcrypto.XOF):
+                    expected=h(key+data).digest(h.length)
+                else:
+                    expected=h(key+data).digest()
+                self.assertEqual(expected,crypt.block(data))
+                self.assertEqual(expected,next(ks))
+                self.assertEqual(expected,crypt.encrypt_block(b"\0"*crypt.block_size,counter))
+
+    def test_blake2_unkeyed_old_format(self):
+        import hashlib
+        key=b"k"*100
+        nonce=b"n"*56
+        data=bytes(notrandom(200))
+        ks=b"".join(hashlib.blake2b(key+nonce+hashcrypto.Q.pack(c)).digest() for c in range(4))
+        fields=("0.4","CTR","blake2b",nonce)
+        cryptfile=io.BytesIO(hashcrypto.MAGIC+b"".join(hashcrypto.pack_plus(f) for f in fields)+
+                             bytes(bytearray(a^b for a,b in zip(bytearray(data),bytearray(ks)))))
+        outfile=io.BytesIO()
+        hashcrypto.decrypt_file(cryptfile,outfile,key)
+        self.assertEqual(data,outfile.getvalue())
+        self.assertFalse(hashcrypto.CTR(key,hashlib.blake2b).keyed)
+
+    def test_blake2_keyed(self):
+        for name in hashcrypto.keyed_lookup:
+            crypt=hashcrypto.CTR(b"k"*20,name)
+            self.assertEqual(hashcrypto.keyed_lookup[name](b"x",key=b"k"*20).digest(),crypt.block(b"x"))
+            self.assertIn(hashcrypto.pack_plus(name),crypt.header())
+            key=b"k"*hashcrypto.CTR.suggest_key_size(name)
+            cryptfile=io.BytesIO()
+            hashcrypto.OFB(key,name).encrypt_file(io.BytesIO(b"data"),cryptfile)
+            cryptfile.seek(0)
+            outfile=io.BytesIO()
+            hashcrypto.decrypt_file(cryptfile,outfile,key)
+            self.assertEqual(b"data",outfile.getvalue())
+
+    def test_xof(self):
+        key=notrandom(20)
+        data=bytes(notrandom(10000))
+        for spec in ("shake_128:1000","shake_256"):
+            crypt=hashcrypto.OFB(key,spec)
+            self.assertEqual(hashcrypto.lookup_hash(spec).length,crypt.block_size)
+            self.assertEqual(hashcrypto.XOF(spec[:9]).name,crypt.hash().name)
+            for cls in hashcrypto.MODES.values():
+                cryptfile=io.BytesIO()
+                cls(key,spec).encrypt_file(io.BytesIO(data),cryptfile)
+                cryptfile.seek(0)
+                outfile=io.BytesIO()
+                hashcrypto.decrypt_file(cryptfile,outfile,key)
+                self.assertEqual(data,outfile.getvalue())
+        for spec in ("sha256:64","blake2b-keyed:64","nohash:64","shake_128:0","shake_128:x",
+                     "shake_256:%d"%(hashcrypto.MAX_XOF_LENGTH+1),"shake_256:%d"%2**62):
+            self.assertRaises(ValueError,hashcrypto.lookup_hash,spec)
+        self.assertRaises(ValueError,hashcrypto.XOF,"sha256")
+        self.assertEqual(hashcrypto.MAX_XOF_LENGTH,hashcrypto.XOF("shake_256",hashcrypto.MAX_XOF_LENGTH).length)
+        # the length in a header is untrusted too
+        header=hashcrypto.CTR(key,"shake_256").header().replace(
+            hashcrypto.pack_plus("shake_256:4096"),hashcrypto.pack_plus("shake_256:%d"%2**40))
+        self.assertRaises(ValueError,hashcrypto.read_header,io.BytesIO(header),key)
+
+    def test_key_change(self):
+        crypt=hashcrypto.OFB(b"old")
+        crypt.key=b"new"
+        self.assertEqual(crypt.hash(b"new1").digest(),crypt.block(b"1"))
+
+
+class TestBulkKeystream(unittest.TestCase):
+    def blockwise(self,crypt,data,*args):
+        bs=crypt.block_size
+        blocks=(data[i:i+bs] for i in range(0,len(data),bs))
+        return b"".join(bytes(b) for b in crypt.encrypt(blocks,*args))
+
+    def test_CTR_encrypt_buffer(self):
+        crypt=hashcrypto.CTR(notrandom(20))
+        data=bytes(notrandom(1000))
+        self.assertEqual(self.blockwise(crypt,data,3),crypt.encrypt_buffer(data,3))
+        self.assertEqual(data,crypt.decrypt_buffer(crypt.encrypt_buffer(data,3),3))
+        ks=bytearray(3*crypt.block_size)
+        self.assertEqual(7,crypt.keystream_into(ks,4))
+        self.assertEqual(crypt.encrypt_buffer(bytes(ks),4),b"\0"*len(ks))
+
+    def test_OFB_encrypt_buffer(self):
+        crypt=hashcrypto.OFB(notrandom(20))
+        data=bytes(notrandom(1000))
+        self.assertEqual(self.blockwise(crypt,data),crypt.encrypt_buffer(data))
+        ks=bytearray(2*crypt.block_size)
+        iv=crypt.keystream_into(ks)
+        rest=bytearray(3*crypt.block_size)
+        crypt.keystream_into(rest,iv)
+        self.assertEqual(bytes(ks+rest),crypt.encrypt_buffer(b"\0"*len(ks+rest)))
+
+
+class TestPipeline(unittest.TestCase):
+    def test_roundtrip(self):
+        data=bytes(notrandom(5000))
+        key=notrandom(20)
+        for crypt in [cls(key) for cls in hashcrypto.MODES.values()]+[hashcrypto.Chunked(key,chunk_size=512)]:
+            expected=io.BytesIO()
+            crypt.encrypt_file(io.BytesIO(data),expected)
+            for depth in (1,3):
+                cryptfile=io.BytesIO()
+                crypt.encrypt_file(ShortReader(data),cryptfile,buffer_size=256,pipeline_depth=depth)
+                self.assertEqual(expected.getvalue(),cryptfile.getvalue())
+                cryptfile.seek(0)
+                outfile=io.BytesIO()
+                hashcrypto.decrypt_file(cryptfile,outfile,key,buffer_size=128,pipeline_depth=depth)
+                self.assertEqual(data,outfile.getvalue())
+
+    def test_errors(self):
+        class Broken(io.RawIOBase):
+            def writable(self):
+                return True
+            def write(self,b):
+                raise IOError("disk full")
+        crypt=hashcrypto.CTR(notrandom(20))
+        self.assertRaises(IOError,crypt.encrypt_stream,io.BytesIO(bytes(notrandom(5000))),Broken(),buffer_size=64,pipeline_depth=2)
+        class Unreadable(io.RawIOBase):
+            def readable(self):
+                return True
+            def readinto(self,b):
+                raise IOError("bad sector")
+        self.assertRaises(IOError,crypt.encrypt_stream,Unreadable(),io.BytesIO(),pipeline_depth=2)
+
+
+class TestParallel(unittest.TestCase):
+    def test_pickle(self):
+        import pickle
+        for cls in hashcrypto.MODES.values():
+            crypt=cls(notrandom(20),"sha256")
+            clone=pickle.loads(pickle.dumps(crypt))
+            self.assertEqual(crypt.header(),clone.header())
+            self.assertEqual(crypt.block(b"x"),clone.block(b"x"))
+
+    def test_parallel_CTR(self):
+        data=bytes(notrandom(5000))
+        crypt=hashcrypto.CTR(notrandom(20))
+        expected=io.BytesIO()
+        crypt.encrypt_file(io.BytesIO(data),expected)
+        cryptfile=io.BytesIO()
+        hashcrypto.parallel_encrypt_file(io.BytesIO(data),cryptfile,crypt.key,nonce=crypt.nonce,workers=2,buffer_size=300)
+        self.assertEqual(expected.getvalue(),cryptfile.getvalue())
+        cryptfile.seek(0)
+        outfile=io.BytesIO()
+        hashcrypto.decrypt_file(cryptfile,outfile,crypt.key,buffer_size=200,workers=3)
+        self.assertEqual(data,outfile.getvalue())
+
+    def test_parallel_CFB_decrypt(self):
+        data=bytes(notrandom(5000))
+        crypt=hashcrypto.CFB(notrandom(20))
+        cryptfile=io.BytesIO()
+        crypt.encrypt_file(io.BytesIO(data),cryptfile)
+        cryptfile.seek(0)
+        outfile=io.BytesIO()
+        hashcrypto.decrypt_file(cryptfile,outfile,crypt.key,buffer_size=200,workers=2)
+        self.assertEqual(data,outfile.getvalue())
+
+    def test_single_job_inline(self):
+        from hashcrypto.parallel import pool_map
+        # a lambda cannot be pickled, so this only works without a pool
+        self.assertEqual([6],list(pool_map(lambda x:2*x,[(3,)],4)))
+        self.assertEqual([],list(pool_map(lambda x:2*x,[],4)))
+        data=bytes(notrandom(1000))
+        for cls in hashcrypto.MODES.values():
+            crypt=cls(notrandom(20))
+            cryptfile=io.BytesIO()
+            crypt.encrypt_file(io.BytesIO(data),cryptfile,workers=4)
+            cryptfile.seek(0)
+            outfile=io.BytesIO()
+            hashcrypto.decrypt_file(cryptfile,outfile,crypt.key,workers=4)
+            self.assertEqual(data,outfile.getvalue())
+
+
+class TestRandomAccess(unittest.TestCase):
+    def test_CTR_open(self):
+        data=bytes(notrandom(3000))
+        key=notrandom(20)
+        cryptfile=io.BytesIO()
+        hashcrypto.CTR(key).encrypt_file(io.BytesIO(data),cryptfile)
+        cryptfile.seek(0)
+        f=hashcrypto.open(cryptfile,key)
+        for start,stop in ((0,10),(63,129),(1000,3000),(2999,4000),(3500,3600)):
+            f.seek(start)
+            self.assertEqual(data[start:stop],f.read(stop-start))
+        self.assertEqual(len(data),f.seek(0,io.SEEK_END))
+        f.close()
+
+    def test_CTR_write(self):
+        data=bytearray(notrandom(3000))
+        key=notrandom(20)
+        crypt=hashcrypto.CTR(key,"sha256")
+        cryptfile=io.BytesIO()
+        crypt.encrypt_file(io.BytesIO(bytes(data)),cryptfile)
+        for buffering,cache_size in ((0,4),(-1,1024)):
+            cryptfile.seek(0)
+            f=hashcrypto.open(cryptfile,key,buffering,mode="r+",cache_size=cache_size)
+            for start,patch in ((5,b"x"),(30,b"y"*40),(1000,bytes(notrandom(500))),(3100,b"z"*10)):
+                f.seek(start)
+                f.write(patch)
+                data.extend(bytearray(max(start-len(data),0)))
+                data[start:start+len(patch)]=patch
+            f.seek(10)
+            self.assertEqual(bytes(data[10:2000]),f.read(1990))
+            f.truncate(3050)
+            del data[3050:]
+            f.flush()
+            expected=io.BytesIO()
+            crypt.encrypt_file(io.BytesIO(bytes(data)),expected)
+            self.assertEqual(expected.getvalue(),cryptfile.getvalue())
+        cryptfile=io.BytesIO()
+        hashcrypto.OFB(key).encrypt_file(io.BytesIO(b"x"),cryptfile)
+        cryptfile.seek(0)
+        self.assertRaises(ValueError,hashcrypto.open,cryptfile,key,mode="r+")
+
+    def test_other_modes(self):
+        cryptfile=io.BytesIO()
+        hashcrypto.CFB(notrandom(20)).encrypt_file(io.BytesIO(b"x"),cryptfile)
+        cryptfile.seek(0)
+        self.assertRaises(ValueError,hashcrypto.open,cryptfile,notrandom(20))
+
+    def test_OFB_checkpoints(self):
+        from hashcrypto.checkpoints import OFBCheckpoints
+        data=bytes(notrandom(5000))
+        key=notrandom(20)
+        crypt=hashcrypto.OFB(key,"sha256")
+        checkpoints=OFBCheckpoints(4)
+        cryptfile=io.BytesIO()
+        crypt.encrypt_file(io.BytesIO(data),cryptfile,buffer_size=100,checkpoints=checkpoints)
+        expected=io.BytesIO()
+        crypt.encrypt_file(io.BytesIO(data),expected)
+        self.assertEqual(expected.getvalue(),cryptfile.getvalue())
+        self.assertEqual(40,checkpoints.count)
+        saved=io.BytesIO()
+        checkpoints.save(saved,crypt)
+        streamed=io.BytesIO()
+        small=OFBCheckpoints.create(streamed,crypt,4,cache_size=3)
+        crypt.encrypt_file(io.BytesIO(data),io.BytesIO(),buffer_size=100,checkpoints=small)
+        self.assertEqual(saved.getvalue(),streamed.getvalue())
+        self.assertEqual(3,len(small._states))
+        for cps in (None,checkpoints,small,OFBCheckpoints.load(io.BytesIO(saved.getvalue()),crypt,cache_size=3)):
+            cryptfile.seek(0)
+            f=hashcrypto.open(cryptfile,key,checkpoints=cps)
+            for start,stop in ((4000,4100),(31,33),(0,5000),(4999,5010),(1000,1200)):
+                f.seek(start)
+                self.assertEqual(data[start:stop],f.read(stop-start))
+        import os
+        import tempfile
+        fd,path=tempfile.mkstemp()
+        try:
+            with io.open(fd,"wb") as sidecar:
+                sidecar.write(saved.getvalue())
+            cryptfile.seek(0)
+            f=hashcrypto.open(cryptfile,key,checkpoints=path)
+            f.seek(4000)
+            self.assertEqual(data[4000:4100],f.read(100))
+            sidecar=f.raw.checkpoints._file
+            f.close()
+            self.assertTrue(sidecar.closed)
+        finally:
+            os.remove(path)
+
+    def test_OFB_checkpoints_per_file(self):
+        from hashcrypto.checkpoints import OFBCheckpoints
+        key=notrandom(20)
+        sidecars=[]
+        for i in range(2):
+            crypt=hashcrypto.OFB(key,"sha256")
+            sidecar=io.BytesIO()
+            crypt.encrypt_file(io.BytesIO(bytes(5000)),io.BytesIO(),checkpoints=OFBCheckpoints.create(sidecar,crypt,4))
+            sidecars.append((crypt,sidecar.getvalue()))
+        (a,sa),(b,sb)=sidecars
+        self.assertNotEqual(OFBCheckpoints.mask(a,1),OFBCheckpoints.mask(b,1))
+        self.assertRaises(ValueError,OFBCheckpoints.load,io.BytesIO(sa),b)
+        self.assertRaises(ValueError,OFBCheckpoints.load,io.BytesIO(sa),hashcrypto.OFB(notrandom(21),"sha256",a.start_iv))
+        self.assertEqual(40,OFBCheckpoints.load(io.BytesIO(sb),b).count)
+
+
+class TestChunked(unittest.TestCase):
+    def test_roundtrip(self):
+        key=notrandom(20)
+        for data in (b"",bytes(notrandom(640)),bytes(notrandom(3000))):
+            for mode in hashcrypto.MODES:
+                for workers in (None,2):
+                    container=hashcrypto.Chunked(key,"sha256",mode=mode,chunk_size=256)
+                    cryptfile=io.BytesIO()
+                    container.encrypt_file(io.BytesIO(data),cryptfile,workers=workers)
+                    cryptfile.seek(0)
+                    outfile=io.BytesIO()
+                    hashcrypto.decrypt_file(cryptfile,outfile,key,workers=workers)
+                    self.assertEqual(data,outfile.getvalue())
+
+    def test_random_access(self):
+        key=notrandom(20)
+        data=bytes(notrandom(3000))
+        for mode in hashcrypto.MODES:
+            cryptfile=io.BytesIO()
+            hashcrypto.Chunked(key,mode=mode,chunk_size=512).encrypt_file(io.BytesIO(data),cryptfile)
+            cryptfile.seek(0)
+            f=hashcrypto.open(cryptfile,key)
+            self.assertEqual(len(data),f.seek(0,io.SEEK_END))
+            for start,stop in ((0,10),(500,1100),(2999,4000),(3500,3600)):
+                f.seek(start)
+                self.assertEqual(data[start:stop],f.read(stop-start))
+
+    def test_old_format_still_readable(self):
+        key=notrandom(20)
+        old=hashcrypto.CTR(key)
+        cryptfile=io.BytesIO()
+        old.encrypt_file(io.BytesIO(b"old data"),cryptfile)
+        cryptfile.seek(0)
+        outfile=io.BytesIO()
+        hashcrypto.decrypt_file(cryptfile,outfile,key)
+        self.assertEqual(b"old data",outfile.getvalue())
+
+    def test_untrusted_sizes(self):
+        key=notrandom(20)
+        container=hashcrypto.Chunked(key,"sha256",chunk_size=256)
+        header=container.header()
+        for data in (Q.pack(257)+bytes(257),Q.pack(2**63)):
+            self.assertRaises(ValueError,hashcrypto.decrypt_file,io.BytesIO(header+data),io.BytesIO(),key)
+        # an index claiming 2**40 entries fails when the data runs out
+        self.assertRaises(ValueError,container.read_offsets,io.BytesIO(Q.pack(2**40)+bytes(80)))
+        too_large=header.replace(b"\x03256",hashcrypto.pack_plus(str(2**40)))
+        self.assertRaises(ValueError,hashcrypto.read_header,io.BytesIO(too_large),key)
+
+    def test_format_version(self):
+        key=notrandom(20)
+        for container in (hashcrypto.Chunked(key),hashcrypto.AuthenticatedChunked(key)):
+            header=container.header()
+            self.assertIn(b"\x011",header)
+            self.assertEqual(container.seed,hashcrypto.read_header(io.BytesIO(header),key).seed)
+            self.assertRaises(ValueError,hashcrypto.read_header,io.BytesIO(header.replace(b"\x011",b"\x012",1)),key)
+
+
+class TestAuthenticated(unittest.TestCase):
+    def encrypt(self,crypt,data,**kwargs):
+        cryptfile=io.BytesIO()
+        crypt.encrypt_file(io.BytesIO(data),cryptfile,**kwargs)
+        return cryptfile.getvalue()
+
+    def decrypt(self,ciphertext,key,**kwargs):
+        outfile=io.BytesIO()
+        hashcrypto.decrypt_file(io.BytesIO(ciphertext),outfile,key,**kwargs)
+        return outfile.getvalue()
+
+    def test_roundtrip(self):
+        key=notrandom(20)
+        for data in (b"",bytes(notrandom(3000))):
+            for cls in hashcrypto.MODES.values():
+                crypt=hashcrypto.Authenticated(cls(key,"sha256"))
+                ciphertext=self.encrypt(crypt,data,buffer_size=256)
+                self.assertEqual(data,self.decrypt(ciphertext,key,buffer_size=512))
+                self.assertEqual(data,self.decrypt(ciphertext,key,pipeline_depth=2))
+
+    def test_tampering(self):
+        key=notrandom(20)
+        ciphertext=bytearray(self.encrypt(hashcrypto.Authenticated(hashcrypto.CTR(key)),bytes(notrandom(3000))))
+        for pos in (len(ciphertext)-2000,len(ciphertext)-1):
+            changed=bytearray(ciphertext)
+            changed[pos]^=1
+            self.assertRaises(hashcrypto.AuthenticationError,self.decrypt,bytes(changed),key)
+        for end in (len(ciphertext)-1,len(ciphertext)-40):
+            self.assertRaises(hashcrypto.AuthenticationError,self.decrypt,bytes(ciphertext[:end]),key)
+
+    def test_chunked(self):
+        key=notrandom(20)
+        data=bytes(notrandom(3000))
+        for mode in hashcrypto.MODES:
+            for workers in (None,2):
+                container=hashcrypto.AuthenticatedChunked(key,"sha256",mode=mode,chunk_size=512)
+                ciphertext=self.encrypt(container,data,workers=workers)
+                self.assertEqual(data,self.decrypt(ciphertext,key,workers=workers))
+        changed=bytearray(ciphertext)
+        changed[len(container.header())+Q.size+600]^=1
+        f=hashcrypto.open(io.BytesIO(bytes(changed)),key,buffering=0)
+        self.assertEqual(data[:512],f.read(512))
+        self.assertRaises(hashcrypto.AuthenticationError,f.read,1)
+        self.assertRaises(hashcrypto.AuthenticationError,self.decrypt,bytes(changed),key)
+
+    def test_chunked_header_tampering(self):
+        key=notrandom(20)
+        container=hashcrypto.AuthenticatedChunked(key,"sha256",chunk_size=512)
+        ciphertext=self.encrypt(container,bytes(notrandom(3000)))
+        for old,new in ((b"\x03CTR",b"\x03OFB"),(b"\x03CTR",b"\x03CFB"),(b"\x03512",b"\x041024"),
+                        (b"\x06sha256 ",b"\x06sha512 ")):
+            self.assertIn(old,ciphertext)
+            changed=ciphertext.replace(old,new,1)
+            self.assertRaises(hashcrypto.AuthenticationError,self.decrypt,changed,key)
+            self.assertRaises(hashcrypto.AuthenticationError,hashcrypto.open,io.BytesIO(changed),key)
+
+    def test_chunked_truncation(self):
+        key=notrandom(20)
+        container=hashcrypto.AuthenticatedChunked(key,chunk_size=512)
+        ciphertext=self.encrypt(container,bytes(notrandom(3000)))
+        records=len(container.header())+6*Q.size+3000+6*container.tag_size
+        truncated=ciphertext[:records-Q.size-512-container.tag_size]+ciphertext[records:]
+        self.assertRaises(hashcrypto.AuthenticationError,self.decrypt,truncated,key)
+
+    def test_chunked_record_size(self):
+        key=notrandom(20)
+        container=hashcrypto.AuthenticatedChunked(key,chunk_size=512)
+        ciphertext=self.encrypt(container,bytes(notrandom(3000)))
+        record=Q.pack(512+container.tag_size)
+        self.assertIn(record,ciphertext)
+        for size in (513+container.tag_size,2**63):
+            changed=ciphertext.replace(record,Q.pack(size),1)
+            with self.assertRaises(ValueError) as cm:
+                self.decrypt(changed,key)
+            self.assertEqual("Chunk record too long",cm.exception.args[0])
+            with self.assertRaises(ValueError) as cm:
+                hashcrypto.open(io.BytesIO(changed),key).read()
+            self.assertEqual("Chunk record too long",cm.exception.args[0])
+
+
+class TestCompressed(unittest.TestCase):
+    def test_roundtrip(self):
+        from hashcrypto.compressed import CODECS
+        key=notrandom(20)
+        data=b"highly compressible text "*2000
+        for codec in CODECS:
+            for crypt in (hashcrypto.CFB(key,"sha256"),hashcrypto.Chunked(key,"sha256",chunk_size=256)):
+                for empty in (False,True):
+                    plain=b"" if empty else data
+                    compressed=hashcrypto.Authenticated(hashcrypto.Compressed(crypt,codec))
+                    cryptfile=io.BytesIO()
+                    compressed.encrypt_file(io.BytesIO(plain),cryptfile,buffer_size=512)
+                    if not empty:
+                        self.assertLess(len(cryptfile.getvalue()),len(data)//10)
+                    cryptfile.seek(0)
+                    outfile=io.BytesIO()
+                    hashcrypto.decrypt_file(cryptfile,outfile,key,pipeline_depth=2)
+                    self.assertEqual(plain,outfile.getvalue())
+
+    def test_truncated(self):
+        key=notrandom(20)
+        cryptfile=io.BytesIO()
+        hashcrypto.Compressed(hashcrypto.CTR(key)).encrypt_file(io.BytesIO(bytes(notrandom(3000))),cryptfile)
+        truncated=io.BytesIO(cryptfile.getvalue()[:-10])
+        self.assertRaises(ValueError,hashcrypto.decrypt_file,truncated,io.BytesIO(),key)
+        self.assertRaises(ValueError,hashcrypto.Compressed,hashcrypto.CTR(key),"nonsense")
+
+    def test_bounded_output(self):
+        from hashcrypto.compressed import CODECS,READ_SIZE
+
+        class Sizes(object):
+            def __init__(self):
+                self.sizes=[]
+            def write(self,b):
+                self.sizes.append(len(b))
+
+        key=notrandom(20)
+        for codec in CODECS:
+            crypt=hashcrypto.Compressed(hashcrypto.CTR(key),codec)
+            cryptfile=io.BytesIO()
+            crypt.encrypt_file(io.BytesIO(bytes(8*1024*1024)),cryptfile)
+            self.assertLess(len(cryptfile.getvalue()),64*1024)
+            cryptfile.seek(0)
+            out=Sizes()
+            hashcrypto.decrypt_file(cryptfile,out,key)
+            self.assertEqual(8*1024*1024,sum(out.sizes))
+            self.assertLessEqual(max(out.sizes),READ_SIZE)
+
+    def test_trailing_data(self):
+        import zlib
+        key=notrandom(20)
+        ctr=hashcrypto.CTR(key)
+        cryptfile=io.BytesIO()
+        cryptfile.write(hashcrypto.Compressed(ctr).header())
+        ctr.encrypt_stream(io.BytesIO(zlib.compress(b"data")+b"junk"),cryptfile)
+        cryptfile.seek(0)
+        self.assertRaises(ValueError,hashcrypto.decrypt_file,cryptfile,io.BytesIO(),key)
+
+
+class TestMany(unittest.TestCase):
+    def test_roundtrip(self):
+        key=notrandom(20)
+        for cls in hashcrypto.MODES.values():
+            crypt=cls(key,"sha256")
+            make=crypt.make_nonce if cls is hashcrypto.CTR else crypt.make_iv
+            items=[(make(crypt.hash),bytes(notrandom(n,n))) for n in (0,1,31,32,33,100)]
+            for workers in (None,2):
+                data,offsets=crypt.encrypt_many(items,workers=workers)
+                self.assertEqual(len(items)+1,len(offsets))
+                for (iv,payload),c in zip(items,hashcrypto.split_many(data,offsets)):
+                    expected=cls(key,"sha256",iv).encrypt_buffer(payload)
+                    self.assertEqual(expected,c)
+                cipher=[(iv,c) for (iv,_),c in zip(items,hashcrypto.split_many(data,offsets))]
+                plain,offsets=crypt.decrypt_many(cipher,workers=workers)
+                self.assertEqual([p for _,p in items],hashcrypto.split_many(plain,offsets))
+
+
+class TestStats(unittest.TestCase):
+    def test_counters(self):
+        from hashcrypto.stats import Stats
+        data=bytes(notrandom(1000))
+        for cls in hashcrypto.MODES.values():
+            calls=[]
+            stats=Stats(calls.append)
+            crypt=cls(notrandom(20))
+            crypt.stats=stats
+            cryptfile=io.BytesIO()
+            crypt.encrypt_file(io.BytesIO(data),cryptfile,buffer_size=256)
+            self.assertEqual(1000,stats.bytes_read)
+            self.assertEqual(len(cryptfile.getvalue()),stats.bytes_written+len(crypt.header()))
+            self.assertEqual(1000,stats.bytes_xored)
+            self.assertEqual(16,stats.blocks_hashed)
+            self.assertEqual(4,len(calls))
+            stats.reset()
+            cryptfile.seek(0)
+            hashcrypto.decrypt_file(cryptfile,io.BytesIO(),crypt.key,stats=stats)
+            self.assertEqual(1000,stats.bytes_written)
+            self.assertEqual(16,stats.blocks_hashed)
+
+    def test_chunked_counters(self):
+        from hashcrypto.stats import Stats
+        container=hashcrypto.Chunked(notrandom(20),chunk_size=256)
+        container.stats=Stats()
+        container.encrypt_stream(io.BytesIO(bytes(notrandom(1000))),io.BytesIO())
+        self.assertEqual(1000,container.stats.bytes_xored)
+        self.assertEqual(1000,container.stats.bytes_read)
+
+
+class TestInplace(unittest.TestCase):
+    def test_roundtrip(self):
+        import os
+        import tempfile
+        data=bytes(notrandom(3000))
+        key=notrandom(20)
+        fd,path=tempfile.mkstemp()
+        os.close(fd)
+        try:
+            for cls in hashcrypto.MODES.values():
+                with io.open(path,"wb") as f:
+                    f.write(data)
+                crypt=cls(key)
+                crypt.encrypt_file_inplace(path,buffer_size=200)
+                expected=io.BytesIO()
+                crypt.encrypt_stream(io.BytesIO(data),expected)
+                with io.open(path,"rb") as f:
+                    self.assertEqual(expected.getvalue(),f.read())
+                hashcrypto.decrypt_file_inplace(path,key,buffer_size=300)
+                with io.open(path,"rb") as f:
+                    self.assertEqual(data,f.read())
+                self.assertFalse(os.path.exists(path+hashcrypto.SIDECAR_SUFFIX))
+        finally:
+            os.remove(path)
+
+    def test_error(self):
+        import os
+        import tempfile
+        data=bytes(notrandom(3000))
+        fd,path=tempfile.mkstemp()
+        os.close(fd)
+
+        def process(chunks):
+            for i,chunk in enumerate(chunks):
+                if i==2:
+                    raise KeyError("process failed")
+                yield bytes(len(chunk))
+
+        try:
+            with io.open(path,"wb") as f:
+                f.write(data)
+            self.assertRaises(KeyError,hashcrypto.crypt_inplace,path,process,1000)
+            with io.open(path,"rb") as f:
+                self.assertEqual(bytes(2000)+data[2000:],f.read())
+        finally:
+            os.remove(path)
+
+    def interrupted(self,crypt,path,chunks):
+        """Encrypt path in place with crypt, failing after chunks chunks."""
+        encrypt_chunks=crypt.encrypt_chunks
+
+        def failing(chunks_in,**kwargs):
+            for i,out in enumerate(encrypt_chunks(chunks_in,**kwargs)):
+                if i==chunks:
+                    raise KeyError("interrupted")
+                yield out
+
+        crypt.encrypt_chunks=failing
+        self.assertRaises(KeyError,crypt.encrypt_file_inplace,path,buffer_size=200)
+        del crypt.encrypt_chunks
+
+    def test_resume_and_undo(self):
+        import os
+        import tempfile
+        data=bytes(notrandom(3000))
+        key=notrandom(20)
+        fd,path=tempfile.mkstemp()
+        os.close(fd)
+        sidecar=path+hashcrypto.SIDECAR_SUFFIX
+        try:
+            for cls in hashcrypto.MODES.values():
+                crypt=cls(key,"sha256")
+                expected=io.BytesIO()
+                crypt.encrypt_stream(io.BytesIO(data),expected)
+                expected=expected.getvalue()
+                # interrupted, resumed
+                with io.open(path,"wb") as f:
+                    f.write(data)
+                self.interrupted(crypt,path,3)
+                self.assertRaises(OSError,crypt.encrypt_file_inplace,path)
+                hashcrypto.resume_file_inplace(path,key,buffer_size=300)
+                with io.open(path,"rb") as f:
+                    self.assertEqual(expected,f.read())
+                hashcrypto.decrypt_file_inplace(path,key)
+                # interrupted while a chunk was half written, resumed
+                self.interrupted(crypt,path,3)
+                with io.open(sidecar,"r+b") as f:
+                    hashcrypto.read_header(f,key)
+                    journal=hashcrypto.InplaceJournal(f,f.tell())
+                    # buffer_size 200 aligned to the sha256 block size
+                    self.assertEqual((576,b""),journal.read())
+                    journal.begin(576,expected[576:768])
+                with io.open(path,"r+b") as f:
+                    f.seek(576)
+                    f.write(expected[576:700])
+                hashcrypto.resume_file_inplace(path,key)
+                with io.open(path,"rb") as f:
+                    self.assertEqual(expected,f.read())
+                hashcrypto.decrypt_file_inplace(path,key)
+                # interrupted, undone
+                self.interrupted(crypt,path,5)
+                hashcrypto.decrypt_file_inplace(path,key)
+                with io.open(path,"rb") as f:
+                    self.assertEqual(data,f.read())
+                self.assertFalse(os.path.exists(sidecar))
+        finally:
+            for p in (path,sidecar):
+                if os.path.exists(p):
+                    os.remove(p)
+
+
+class TestAppend(unittest.TestCase):
+    def test_append(self):
+        import os
+        import tempfile
+        key=notrandom(20)
+        data=bytes(notrandom(3000))
+        fd,path=tempfile.mkstemp()
+        os.close(fd)
+        try:
+            crypt=hashcrypto.CTR(key,"sha256")
+            for first,rest in ((0,64),(100,64),(64,1000),(1000,0)):
+                with io.open(path,"wb") as f:
+                    crypt.encrypt_file(io.BytesIO(data[:first]),f)
+                self.assertEqual(rest,hashcrypto.append_to_file(path,key,io.BytesIO(data[first:first+rest]),buffer_size=256))
+                expected=io.BytesIO()
+                crypt.encrypt_file(io.BytesIO(data[:first+rest]),expected)
+                with io.open(path,"rb") as f:
+                    self.assertEqual(expected.getvalue(),f.read())
+            with io.open(path,"wb") as f:
+                hashcrypto.OFB(key).encrypt_file(io.BytesIO(data),f)
+            self.assertRaises(ValueError,hashcrypto.append_to_file,path,key,io.BytesIO(data))
+        finally:
+            os.remove(path)
+
+
+class TestRekey(unittest.TestCase):
+    def test_rekey(self):
+        data=bytes(notrandom(3000))
+        old_key=notrandom(20)
+        new_key=notrandom(20,7)
+        for old_mode,old_hash,new_mode,new_hash,workers in (("CTR","sha256",None,None,None),
+                                                            ("CTR","sha256","CTR","sha512",2),
+                                                            ("CTR","sha512",None,"sha384",None),
+                                                            ("OFB","sha256","CFB",None,None),
+                                                            ("CFB","sha512","CTR","sha256",2)):
+            cryptfile=io.BytesIO()
+            hashcrypto.MODES[old_mode](old_key,old_hash).encrypt_file(io.BytesIO(data),cryptfile)
+            cryptfile.seek(0)
+            rekeyed=io.BytesIO()
+            new=hashcrypto.rekey_file(cryptfile,rekeyed,old_key,new_key,new_mode,new_hash,
+                                      buffer_size=200,workers=workers)
+            self.assertEqual(new_mode or old_mode,type(new).__name__)
+            self.assertEqual(new_hash or old_hash,new.hash_name())
+            rekeyed.seek(0)
+            outfile=io.BytesIO()
+            hashcrypto.decrypt_file(rekeyed,outfile,new_key)
+            self.assertEqual(data,outfile.getvalue())
+
+
+class TestKeystreamPool(unittest.TestCase):
+    def test_reservations(self):
+        import threading
+        import time
+        crypt=hashcrypto.CTR(notrandom(20),"sha256")
+        with hashcrypto.KeystreamPool(crypt,capacity=4096,batch_size=1024) as pool:
+            deadline=time.time()+5
+            while pool.metrics()["buffered_bytes"]<4096 and time.time()<deadline:
+                time.sleep(0.01)
+            counter,ciphertext=pool.encrypt(b"hello")
+            self.assertEqual((0,b"hello"),(counter,crypt.decrypt_buffer(ciphertext,counter)))
+            self.assertEqual(1,pool.metrics()["hits"])
+            results=[]
+
+            def worker():
+                for n in (1,31,32,100,5000):
+                    results.append((n,)+pool.reserve(n))
+
+            threads=[threading.Thread(target=worker) for _ in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            used=set()
+            for n,counter,ks in results:
+                blocks=set(range(counter,counter-(-n//32)))
+                self.assertFalse(used&blocks)
+                used|=blocks
+                self.assertEqual(crypt.encrypt_buffer(bytearray(n),counter),bytes(ks))
+            metrics=pool.metrics()
+            self.assertEqual(21,metrics["hits"]+metrics["misses"])
+            self.assertEqual(max(used)+1,metrics["next_counter"])
+        self.assertRaises(ValueError,pool.reserve,1)
+
+    def test_no_worker(self):
+        crypt=hashcrypto.CTR(notrandom(20),"sha256")
+        pool=hashcrypto.KeystreamPool(crypt,start=False,counter_start=10)
+        self.assertEqual((10,crypt.encrypt_buffer(bytearray(40),10)),pool.reserve(40))
+        self.assertEqual(12,pool.reserve(1)[0])
+        self.assertEqual((0,2,3),(pool.metrics()["hits"],pool.metrics()["misses"],pool.metrics()["blocks_inline"]))
+        pool.close()
+
+
+class TestTuning(unittest.TestCase):
+    def test_profile(self):
+        import os
+        import tempfile
+        from hashcrypto import tuning, xor
+        saved=tuning._profile,tuning._loaded
+        no_profile=os.environ.pop("HASHCRYPTO_NO_PROFILE",None)
+        path=os.path.join(tempfile.mkdtemp(),"profile.json")
+        os.environ["HASHCRYPTO_PROFILE"]=path
+        try:
+            profile=hashcrypto.tune(min_time=0.01)
+            self.assertTrue(os.path.exists(path))
+            tuning._loaded=False
+            self.assertEqual(profile,tuning.load_profile())
+            self.assertEqual(profile["xor"],xor.get_backend())
+            crypt=hashcrypto.CTR(notrandom(20))
+            # the tuned hash only applies where it is recorded in a header
+            self.assertEqual(hashcrypto.lookup_hash("sha512"),crypt.hash)
+            self.assertEqual(crypt.aligned_buffer_size(),profile["buffer_size"])
+            tuned=hashcrypto.lookup_hash(profile["hash"])
+            self.assertEqual(tuned,hashcrypto.default_hash(notrandom(20)))
+            self.assertEqual(hashcrypto.default_hash(notrandom(200)),hashcrypto.lookup_hash("sha512") if hashcrypto.is_keyed(tuned) else tuned)
+            self.assertEqual(hashcrypto.CTR(notrandom(20),"sha256").hash,hashcrypto.lookup_hash("sha256"))
+        finally:
+            del os.environ["HASHCRYPTO_PROFILE"]
+            if no_profile is not None:
+                os.environ["HASHCRYPTO_NO_PROFILE"]=no_profile
+            tuning._profile,tuning._loaded=saved
+            xor.set_backend()
+            os.remove(path)
+            os.rmdir(os.path.dirname(path))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,77 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+import hashcrypto
+import hashcrypto.tree
+
+
+class TestTree(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.src = os.path.join(self.dir, "src")
+        self.files = {"a": b"", "b": b"small" * 10, os.path.join("sub", "c"): os.urandom(300 * 1024)}
+        for path, data in self.files.items():
+            path = os.path.join(self.src, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with io.open(path, "wb") as f:
+                f.write(data)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def read_tree(self, root):
+        result = {}
+        for path, size in hashcrypto.tree.walk(root):
+            with io.open(os.path.join(root, path), "rb") as f:
+                result[path] = f.read()
+        return result
+
+    def test_roundtrip(self):
+        key = b"tree key"
+        for workers in (None, 2):
+            enc = os.path.join(self.dir, "enc%s" % workers)
+            dec = os.path.join(self.dir, "dec%s" % workers)
+            summary = hashcrypto.tree.encrypt_tree(self.src, enc, key, "OFB", "sha256",
+                                                   mac=True, workers=workers)
+            self.assertEqual((3, 0, []), (summary.files, summary.skipped, summary.failures))
+            self.assertEqual(sum(len(d) for d in self.files.values()), summary.bytes_read)
+            summary = hashcrypto.tree.decrypt_tree(enc, dec, key, workers=workers)
+            self.assertEqual(3, summary.files)
+            self.assertEqual(self.files, self.read_tree(dec))
+        ivs = set(hashcrypto.read_header(io.BytesIO(data), key).crypt.start_iv
+                  for data in self.read_tree(enc).values())
+        self.assertEqual(3, len(ivs))
+
+    def test_resume_and_failures(self):
+        key = b"tree key"
+        enc = os.path.join(self.dir, "enc")
+        dec = os.path.join(self.dir, "dec")
+        hashcrypto.tree.encrypt_tree(self.src, enc, key)
+        os.remove(os.path.join(enc, "b"))
+        summary = hashcrypto.tree.encrypt_tree(self.src, enc, key)
+        self.assertEqual((1, 2), (summary.files, summary.skipped))
+        with io.open(os.path.join(enc, "a"), "wb") as f:
+            f.write(b"not encrypted")
+        summary = hashcrypto.tree.decrypt_tree(enc, dec, key)
+        self.assertEqual(2, summary.files)
+        self.assertEqual(["a"], [path for path, error in summary.failures])
+        self.assertEqual(["b", os.path.join("sub", "c")], sorted(self.read_tree(dec)))
+
+    def test_compress(self):
+        key = b"tree key"
+        enc = os.path.join(self.dir, "enc")
+        dec = os.path.join(self.dir, "dec")
+        hashcrypto.tree.encrypt_tree(self.src, enc, key, mac=True, compress="zlib")
+        crypt = hashcrypto.read_header(io.BytesIO(self.read_tree(enc)["b"]), key).crypt
+        self.assertEqual("zlib", crypt.codec)
+        hashcrypto.tree.decrypt_tree(enc, dec, key)
+        self.assertEqual(self.files, self.read_tree(dec))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,32 @@
+import unittest
+import hashcrypto
+import hashcrypto.xor
+
+
+def ba(*args):
+    return bytes(bytearray(*args))
+
+
+class TestXorBackends(unittest.TestCase):
+
+    def tearDown(self):
+        hashcrypto.xor.set_backend()
+
+    def test_backends_agree(self):
+        a = ba(i * 7 & 0xFF for i in range(10000))
+        b = ba(i * 13 & 0xFF for i in range(9000))
+        for x, y in ((a, b), (b, a), (a[:64], b[:64]), (a[:1], b), (b"", a),
+                     (bytearray(a), memoryview(b))):
+            expected = hashcrypto.bytesop_fallback.op_xor(x, y)
+            for name in hashcrypto.xor.available_backends():
+                self.assertEqual(expected, ba(hashcrypto.xor.backends[name](x, y)), name)
+
+    def test_set_backend(self):
+        for name in hashcrypto.xor.available_backends():
+            hashcrypto.xor.set_backend(name)
+            self.assertEqual(name, hashcrypto.xor.get_backend())
+            self.assertEqual(ba(3), ba(hashcrypto.op_xor(ba(3), ba(3))))
+        self.assertRaises(ValueError, hashcrypto.xor.set_backend, "nope")
+
+if __name__ == '__main__':
+    unittest.main()